@@ -1,10 +1,12 @@
-import json
-import requests
 import secrets
-from helper import get_ng_payload, reply
-from bot_info import oauth_token
-from cloudvolume import CloudVolume
+from helper import get_ng_payload, reply, post_state, cache_volume, trim_cache, merge_bboxes, map_bounded
 import numpy as np
+import fastremap
+import edt
+from cloudvolume.lib import Bbox
+
+# voxels counted at a time, bounds the temporary index arrays
+BLOCK = 1 << 24
 
 
 def find_first_seg_layer(layers):
@@ -22,31 +24,71 @@ def find_first_graphene_layer(layers):
             return [l['name'], l['source']]
     return None
 
-def idx_to_coord(bbox, idx):
-    dim = [bbox[i+3] - bbox[i] for i in range(3)]
-    strides = [dim[-2]*dim[-1], dim[-1], 1]
-    x = int(idx/strides[0])
-    y = int(idx%strides[0]/strides[1])
-    z = int(idx%strides[1])
-    return [bbox[0]+x, bbox[1]+y, bbox[2]+z]
-
-
-def add_segids(cv_seg, bbox, threshold):
-    cutout = np.squeeze(cv_seg[bbox[0]:bbox[3], bbox[1]:bbox[4], bbox[2]:bbox[5]])
-    segs, idx, size  = np.unique(cutout, return_counts=True, return_index=True)
-    segs[size < threshold] = 0
-    seglist = []
-    sorted_idx = np.argsort(size)
-    for i in sorted_idx[::-1]:
-        if segs[i] != 0:
-            seglist.append((segs[i], idx_to_coord(bbox, idx[i])))
-    print(seglist[0])
+def deepest_voxels(labels, dt):
+    """Index of the voxel with the largest dt of every label"""
+    order = np.lexsort((-dt, labels))
+    sorted_labels = labels[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_labels[1:] != sorted_labels[:-1]
+    return order[first]
+
+
+def segment_points(seg, threshold, interior=False, anisotropy=(1, 1, 1)):
+    """[(segid, (x, y, z) voxel inside it)] of the segments of seg with at least threshold voxels, largest first
+
+    The ids are renumbered with a hash map and counted with bincount, so
+    nothing is sorted but the retained segments. The point is any voxel of
+    the segment, or with interior=True the one farthest from its boundary
+    (by a distance transform), so it does not land on the edge; that needs
+    a sort, but only of one block of voxels at a time.
+    """
+    order = 'F' if seg.flags.f_contiguous else 'C'
+    labels, remap = fastremap.renumber(seg, preserve_zero=True, in_place=False)
+    n = max(remap.values()) + 1 if remap else 1
+    flat = labels.ravel(order=order)
+    counts = np.zeros(n, dtype=np.int64)
+    for s in range(0, flat.size, BLOCK):
+        counts += np.bincount(flat[s:s+BLOCK], minlength=n)
+
+    # one voxel index per label; any voxel is a valid one, so the writes may overlap
+    points = np.zeros(n, dtype=np.int64)
+    if interior:
+        dt = edt.edt(labels, anisotropy=anisotropy, black_border=False, order=order).ravel(order=order)
+        # the deepest voxel of every label in each block, then the deepest of those
+        candidates = []
+        for s in range(0, flat.size, BLOCK):
+            idx = deepest_voxels(flat[s:s+BLOCK], dt[s:s+BLOCK])
+            candidates.append(idx + s)
+        idx = np.concatenate(candidates)
+        idx = idx[deepest_voxels(flat[idx], dt[idx])]
+        points[flat[idx]] = idx
+    else:
+        for s in range(0, flat.size, BLOCK):
+            points[flat[s:s+BLOCK]] = np.arange(s, min(s+BLOCK, flat.size))
+
+    segids = np.zeros(n, dtype=seg.dtype)
+    for k, v in remap.items():
+        segids[v] = k
+    keep = np.flatnonzero((counts >= threshold) & (segids != 0))
+    keep = keep[np.argsort(counts[keep])[::-1]]
+    coords = np.unravel_index(points[keep], seg.shape, order=order)
+    return [(segids[k], tuple(int(c[i]) for c in coords)) for i, k in enumerate(keep)]
+
+
+def add_segids(cv_seg, bbox, threshold, interior=False, cutout=None):
+    """Segments of cv_seg in bbox, cutout is the bbox if it was already downloaded"""
+    if cutout is None:
+        cutout = cv_seg[bbox[0]:bbox[3], bbox[1]:bbox[4], bbox[2]:bbox[5]][:, :, :, 0]
+    seglist = [(segid, [bbox[i] + pt[i] for i in range(3)])
+               for segid, pt in segment_points(cutout, threshold, interior, tuple(cv_seg.resolution))]
+    if seglist:
+        print(seglist[0])
     return seglist
 
 
-def cv_scale_with_data(path):
+def cv_scale_with_data(path, cache=None):
     print(path)
-    vol = CloudVolume(path)
+    vol = cache_volume(path, cache)
     try:
         for m in vol.available_mips:
             if vol.image.has_data(m):
@@ -56,8 +98,54 @@ def cv_scale_with_data(path):
         return vol.scales[0]['resolution']
 
 
-def convert_pt_to_bbox(handle, url, parameters):
-    payload = get_ng_payload(handle, url)
+def estimate_bboxes(payload, parameters):
+    """Voxels of segmentation read for all the point annotations of a neuroglancer state"""
+    n = 0
+    for l in payload['layers']:
+        if 'annotations' in l and l.get('visible', True):
+            n += sum(1 for a in l['annotations'] if a['type'] == "point")
+    dim = parameters['dim']
+    return n * dim[0] * dim[1] * dim[2]
+
+
+def select_segments(seg_vol, bboxes, parameters):
+    """Segments of every bbox, in order, see add_segids
+
+    Overlapping or nearby bboxes are grouped, and every group is downloaded
+    once as the union of its bboxes by parameters['parallel'] threads. The
+    unions in flight hold at most parameters['in_flight_boxes'] times the
+    voxels of the largest bbox.
+    """
+    boxes = [Bbox.from_list(b) for b in bboxes]
+    largest = max(b.volume() for b in boxes)
+    max_volume = parameters.get('max_union_boxes', 1) * largest
+    groups = merge_bboxes(boxes, gap=parameters.get('merge_gap', 0), max_volume=max_volume)
+    print("{} bboxes in {} downloads".format(len(bboxes), len(groups)))
+    interior = parameters.get('interior_points', False)
+
+    def process_group(group):
+        union, members = group
+        cutout = seg_vol[union.to_slices()][:, :, :, 0]
+        segs = {}
+        for i in members:
+            local = boxes[i] - union.minpt
+            segs[i] = add_segids(seg_vol, bboxes[i], parameters['size_threshold'], interior,
+                                 cutout[local.to_slices()])
+        # keep the cache within its budget while the job runs, not only at its end
+        trim_cache(parameters.get('cache'), parameters.get('cache', {}).get('trim_interval', 0))
+        return segs
+
+    segs = {}
+    results = map_bounded(process_group, groups, [union.volume() for union, _ in groups],
+                          parameters.get('parallel', 1), parameters.get('in_flight_boxes', 1) * largest)
+    for r in results:
+        segs.update(r)
+    return [s for i in range(len(bboxes)) for s in segs[i]]
+
+
+def convert_pt_to_bbox(handle, url, parameters, payload=None):
+    if payload is None:
+        payload = get_ng_payload(handle, url)
     layers = payload['layers']
     seg_layer = find_first_seg_layer(layers)
     if not seg_layer:
@@ -67,12 +155,12 @@ def convert_pt_to_bbox(handle, url, parameters):
 
     if seg_layer:
         reply(handle, f"Select segments > {parameters['size_threshold']} voxels in the bboxes in segmentation layer {seg_layer[0]} ({seg_layer[1]})")
-        scales = cv_scale_with_data(seg_layer[1])
-        seg_vol = CloudVolume(seg_layer[1], mip=scales)
+        scales = cv_scale_with_data(seg_layer[1], parameters.get('cache'))
+        seg_vol = cache_volume(seg_layer[1], parameters.get('cache'), mip=scales)
         if seg_layer[1].startswith("graphene://"):
             seg_vol.agglomerate = True
 
-    seglist = []
+    seg_bboxes = []
 
     reply(handle, f"Convert point annotations to bboxes of {parameters['dim']}")
 
@@ -89,9 +177,8 @@ def convert_pt_to_bbox(handle, url, parameters):
                         maxpt = [minpt[i] + parameters['dim'][i] for i in range(3)]
                         print(minpt, maxpt)
                         bbox = [int(minpt[i]*voxelSize[i]/scales[i]) for i in range(3)] + [int(maxpt[i]*voxelSize[i]/scales[i]) for i in range(3)]
-                        reply(handle, f"bbox: {bbox}")
-                        if seg_layer:
-                            seglist += add_segids(seg_vol, bbox, parameters['size_threshold'])
+                        reply(handle, f"bbox: {bbox}", batch=True)
+                        seg_bboxes.append(bbox)
                         bbox_annotation = {
                             "pointA": minpt,
                             "pointB": maxpt,
@@ -101,6 +188,10 @@ def convert_pt_to_bbox(handle, url, parameters):
                         new_bboxes.append(bbox_annotation)
                 l['annotations'] += new_bboxes
 
+    seglist = []
+    if seg_layer and seg_bboxes:
+        seglist = select_segments(seg_vol, seg_bboxes, parameters)
+
     if len(seglist) > 0:
         anno_layer = {
             "tool": "annotatePoint",
@@ -138,11 +229,5 @@ def convert_pt_to_bbox(handle, url, parameters):
 
         layers.append(anno_layer)
 
-    headers = {'Authorization': 'Bearer {}'.format(oauth_token)}
-    r = requests.post('https://globalv1.daf-apis.com/nglstate/post', headers=headers, data=json.dumps(payload))
-    link = r.text.strip()
-    link = link[1:-1]
-
-    ng_link = "https://neuromancer-seung-import.appspot.com/?json_url={}".format(link)
-
-    return ng_link
+    trim_cache(parameters.get('cache'))
+    return post_state(payload)
@@ -4,17 +4,21 @@ T Macrina
 
 Create VAST directory from CloudVolume cutout
 """
-from cloudvolume import CloudVolume
 from cloudvolume.lib import Bbox, Vec
-from helper import draw_bounding_cube, write_to_dir, reply, user_info, safe_string, create_bucket_url, get_ng_payload
+from helper import merge_bboxes, map_bounded, draw_bounding_cube, write_to_dir, write_to_h5, cache_volume, trim_cache, reply, user_info, safe_string, create_bucket_url, get_ng_payload
 import os
 import json
 import urllib
 import secrets
+import hashlib
+import shutil
 import requests
 from datetime import datetime
 from collections import OrderedDict
 
+# directory under the cutout prefix indexing the cutouts by cutout_key
+CUTOUT_INDEX = ".gtbot_cutouts"
+
 
 def get_first_image_layer(layers):
     for l in layers:
@@ -45,9 +49,31 @@ def get_bboxes(layers):
     return bboxes
 
 
-def parse_nglink(handle, url, parameters):
+def estimate_cutouts(payload, parameters):
+    """Voxels downloaded for all the bbox annotations of a neuroglancer state"""
+    mip = parameters['mip']
+    pad = parameters['pad']
+    total = 0
+    for b in get_bboxes(payload['layers']):
+        bbox = b['bbox']
+        size = [abs(bbox[i+3] - bbox[i]) + 2*pad[i] for i in range(3)]
+        total += (size[0] >> mip) * (size[1] >> mip) * size[2]
+    return total
+
+
+def parse_nglink(handle, url, parameters, payload=None):
+    """Create a cutout for every bbox annotation of the link, returns their summaries
+
+    Overlapping bboxes are downloaded once as their union, unless it is bigger
+    than parameters['max_union_cutouts'] cutouts, and the unions are
+    downloaded and written by parameters['parallel'] threads sharing one
+    CloudVolume, which reads through the chunk cache in parameters['cache'].
+    The unions in flight hold at most parameters['in_flight_cutouts'] times
+    the voxels of the largest cutout.
+    """
     reply(handle, "Analysing neuroglancer link...")
-    payload = get_ng_payload(handle, url)
+    if payload is None:
+        payload = get_ng_payload(handle, url)
     if payload is None:
         return
     layers = payload['layers']
@@ -59,14 +85,113 @@ def parse_nglink(handle, url, parameters):
     if len(bboxes) == 0:
         return
     author = safe_string(user_info(handle, "display_name"))
-    for b in bboxes:
-        dirname = os.path.join(author, b['name'])
-        cloudvolume_to_dir(handle, cv_path, dirname, b['bbox'], parameters)
+    cv = cache_volume(cv_path, parameters.get('cache'), mip=parameters['mip'], fill_missing=True)
+    # bboxes cut out before with the same parameters are linked instead of downloaded
+    sources = [find_cutout(cutout_key(cv_path, b['bbox'], parameters), parameters) for b in bboxes]
+    todo = [i for i in range(len(bboxes)) if sources[i] is None]
+    vol_bboxes = [cutout_bbox(cv, bboxes[i]['bbox'], parameters)[0] for i in todo]
+    largest = max([b.volume() for b in vol_bboxes] or [0])
+    merged = merge_bboxes(vol_bboxes, max_volume=parameters.get('max_union_cutouts', 1) * largest)
+    groups = [(union, [todo[i] for i in members]) for union, members in merged]
+    vol_bboxes = dict(zip(todo, vol_bboxes))
+    print("{} bboxes in {} downloads, {} cut out before".format(len(bboxes), len(groups), len(bboxes) - len(todo)))
+
+    def process_group(group):
+        union, members = group
+        img = cv[union.to_slices()][:,:,:,0]
+        msgs = []
+        for i in members:
+            local = vol_bboxes[i] - union.minpt
+            dirname = os.path.join(author, bboxes[i]['name'])
+            msgs.append(cloudvolume_to_dir(handle, cv_path, dirname, bboxes[i]['bbox'], parameters, cv=cv,
+                                           img=img[local.to_slices()]))
+        # keep the cache within its budget while the job runs, not only at its end
+        trim_cache(parameters.get('cache'), parameters.get('cache', {}).get('trim_interval', 0))
+        return msgs
+
+    msgs = []
+    for i in range(len(bboxes)):
+        if sources[i] is not None:
+            dirname = os.path.join(author, bboxes[i]['name'])
+            msgs.append(cloudvolume_to_dir(handle, cv_path, dirname, bboxes[i]['bbox'], parameters, cv=cv,
+                                           source=sources[i]))
+    parallel = parameters.get('parallel', 4)
+    results = map_bounded(process_group, groups, [union.volume() for union, _ in groups], parallel,
+                          parameters.get('in_flight_cutouts', parallel) * largest)
+    for r in results:
+        msgs += r
+    trim_cache(parameters.get('cache'))
     reply(handle, "done!", broadcast=True)
+    return msgs
+
+
+def cutout_bbox(cv, bbox, parameters):
+    """(padded cutout bbox, annotated bbox) at the mip of cv for a mip 0 bbox list"""
+    mip = parameters['mip']
+    pad = Vec(*parameters['pad'])
+    mip0_bbox = Bbox.from_list(bbox)
+    vol_bbox = cv.bbox_to_mip(Bbox(mip0_bbox.minpt - pad, mip0_bbox.maxpt + pad), 0, mip)
+    draw_bbox = cv.bbox_to_mip(mip0_bbox, 0, mip)
+    return vol_bbox, draw_bbox
+
+
+def cutout_key(cv_path, bbox, parameters):
+    """Digest of everything that determines the files of a cutout"""
+    key = [cv_path, parameters['mip'], list(bbox), list(parameters['pad']), parameters.get('extension', 'png'),
+           parameters.get('compress_level'), parameters.get('stack', True), parameters.get('volume', False)]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+def find_cutout(key, parameters):
+    """Directory of an earlier cutout with the key, None if there is none or it was removed"""
+    try:
+        with open(os.path.join(parameters['prefix'], CUTOUT_INDEX, key)) as f:
+            path = f.read().strip()
+    except IOError:
+        return None
+    if not os.path.exists(os.path.join(path, 'metadata.json')):
+        return None
+    return path
+
+
+def record_cutout(key, path, parameters):
+    index = os.path.join(parameters['prefix'], CUTOUT_INDEX)
+    os.makedirs(index, exist_ok=True)
+    tmp_fn = os.path.join(index, "{}.{}.tmp".format(key, os.getpid()))
+    with open(tmp_fn, 'w') as f:
+        f.write(path)
+    os.replace(tmp_fn, os.path.join(index, key))
+
+
+def link_cutout(src, dst, extension):
+    """Bring the files cloudvolume_to_dir wrote for the cutout at src into dst
+
+    Only the raw sections and raw.h5 are taken, never what annotators added
+    to the earlier cutout (exports, revision histories). The sections are
+    hardlinked (or copied, across file systems), raw.h5 is always copied
+    since it may be opened for writing.
+    """
+    src_raw = os.path.join(src, "raw")
+    if os.path.isdir(src_raw):
+        dst_raw = os.path.join(dst, "raw")
+        os.makedirs(dst_raw, exist_ok=True)
+        for name in os.listdir(src_raw):
+            if not name.endswith("." + extension):
+                continue
+            out_fn = os.path.join(dst_raw, name)
+            if os.path.exists(out_fn):
+                os.remove(out_fn)
+            try:
+                os.link(os.path.join(src_raw, name), out_fn)
+            except OSError:
+                shutil.copy2(os.path.join(src_raw, name), out_fn)
+    os.makedirs(dst, exist_ok=True)
+    if os.path.exists(os.path.join(src, "raw.h5")):
+        shutil.copy2(os.path.join(src, "raw.h5"), os.path.join(dst, "raw.h5"))
 
 
 def cloudvolume_to_dir(handle, cv_path, output_path, bbox, parameters,
-                       extension='png', **kwargs):
+                       extension='png', cv=None, img=None, source=None, **kwargs):
     """Save bbox from src_path to directory of tifs at dst_path
 
     Args:
@@ -77,7 +202,15 @@ def cloudvolume_to_dir(handle, cv_path, output_path, bbox, parameters,
                   prefix to generate the full local path
                   the mip level of the cloudvolume image,
                   padding beyond size to be noted in the image at MIP0
-      extension: str for image file extension
+                  optionally the png compress_level, whether to write the
+                  section stack and the raw.h5 volume
+      extension: str for image file extension, parameters['extension']
+                 (png or tif) takes precedence
+      cv: open CloudVolume of cv_path at the mip, to share one between cutouts
+      img: the padded cutout if it was already downloaded (e.g. as part of a union)
+      source: directory of the same cutout made before, its files are linked
+              instead of downloading again. Without img and source the cutout
+              index is looked up.
     """
 
     author = user_info(handle, "display_name")
@@ -85,20 +218,35 @@ def cloudvolume_to_dir(handle, cv_path, output_path, bbox, parameters,
     mip = parameters['mip']
     pad = parameters['pad']
     local_prefix = parameters['prefix']
-    cv = CloudVolume(cv_path, mip=mip, fill_missing=True)
-    pad = Vec(*pad)
+    if cv is None:
+        cv = cache_volume(cv_path, parameters.get('cache'), mip=mip, fill_missing=True)
+    extension = parameters.get('extension', extension)
     full_raw_path = os.path.join(local_prefix, output_path, "raw")
-    os.makedirs(full_raw_path, exist_ok=True)
-    mip0_bbox = Bbox.from_list(bbox)
-    vol_start = mip0_bbox.minpt
-    vol_stop = mip0_bbox.maxpt
-    vol_bbox = cv.bbox_to_mip(Bbox(vol_start - pad, vol_stop + pad), 0, mip)
-    draw_bbox = cv.bbox_to_mip(mip0_bbox, 0, mip)
-    img = cv[vol_bbox.to_slices()][:,:,:,0]
-    local_draw_bbox = draw_bbox - vol_bbox.minpt
-    if any(x != 0 for x in pad):
-        draw_bounding_cube(img, local_draw_bbox, val=255)
-    write_to_dir(full_raw_path, img, extension=extension)
+    vol_bbox, draw_bbox = cutout_bbox(cv, bbox, parameters)
+    key = cutout_key(cv_path, bbox, parameters)
+    if source is None and img is None:
+        source = find_cutout(key, parameters)
+    if source is not None and os.path.abspath(source) == os.path.abspath(os.path.join(local_prefix, output_path)):
+        source = None
+    if source is not None:
+        link_cutout(source, os.path.join(local_prefix, output_path), extension)
+    else:
+        if parameters.get('stack', True):
+            os.makedirs(full_raw_path, exist_ok=True)
+        else:
+            os.makedirs(os.path.join(local_prefix, output_path), exist_ok=True)
+        if img is None:
+            img = cv[vol_bbox.to_slices()][:,:,:,0]
+        else:
+            # the cube is drawn into the image, do not touch the shared union
+            img = img.copy()
+        local_draw_bbox = draw_bbox - vol_bbox.minpt
+        if any(x != 0 for x in pad):
+            draw_bounding_cube(img, local_draw_bbox, val=255)
+        if parameters.get('stack', True):
+            write_to_dir(full_raw_path, img, extension=extension, compress_level=parameters.get('compress_level'))
+        if parameters.get('volume', False):
+            write_to_h5(os.path.join(local_prefix, output_path, "raw.h5"), img)
 
 
     metadata = {
@@ -112,12 +260,16 @@ def cloudvolume_to_dir(handle, cv_path, output_path, bbox, parameters,
             'dst_path': os.path.join(local_prefix, output_path)
         }
     }
+    if source is not None:
+        metadata['raw']['copied_from'] = source
 
     with open(os.path.join(local_prefix, output_path, 'metadata.json'), 'w') as f:
         json.dump(metadata, f, indent=2)
+    if source is None:
+        record_cutout(key, os.path.join(local_prefix, output_path), parameters)
 
     msg = '''
-Cutout volume `{name}` created!
+Cutout volume `{name}` created{reused}!
 bucket path: `{path}`
 Image layer: `{cv_path}`
 Bounding box: [{bbox}]
@@ -126,6 +278,7 @@ Mip level: {mip}
 Padding: [{pad}]
 '''.format(
         name=output_path,
+        reused=" from `{}`".format(create_bucket_url(source)) if source is not None else "",
         path=create_bucket_url(os.path.join(local_prefix, output_path)),
         cv_path=cv_path,
         bbox=", ".join(str(x) for x in bbox),
@@ -133,6 +286,7 @@ Padding: [{pad}]
         mip=mip,
         pad=", ".join(str(x) for x in pad))
     reply(handle, msg)
+    return msg
 
 
 if __name__ == '__main__':
@@ -1,20 +1,22 @@
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
-from slack_sdk import WebClient
 import json
 import string
 import re
 import os
 import logging
-import time
-from helper import reply, guess_path
-from uploader import upload_dataset
-from downloader import parse_nglink
-from bbox import convert_pt_to_bbox
-from bot_info import slack_token, botid, workspace_prefix
+from helper import reply, guess_path, dataset_key, get_ng_payload, slack_client, TTLCache, set_profile_cache, \
+    PROFILE_TTL, PROFILE_CACHE_SIZE
+from uploader import upload_dataset, estimate_upload, check_upload_options
+from downloader import parse_nglink, estimate_cutouts
+from scheduler import SchedulerManager
+from bbox import convert_pt_to_bbox, estimate_bboxes
+from bot_info import botid, workspace_prefix
 from fortunate import Fortunate
 import random
 import wikiquote
+import time
+import threading
 
 import multiprocessing as mp
 
@@ -26,17 +28,91 @@ cmd_list = {
     'createbbox': r"""create[\s]*bbox(es)?[\s,:]*['"`<]*(([!#$&-;=?-\[\]{}"_a-z~]|%[0-9a-fA-F]{2})+)[>'"`]*"""
 }
 
+# local disk cache of the chunks read by cutouts and bbox conversion
+cache_parameters = {
+    'path': os.path.join(os.path.expanduser("~"), ".cache", "gtbot", "chunks"),
+    'max_bytes': 50*1024**3,
+    # seconds after which cached chunks are dropped, layers can be rewritten in place
+    'max_age': 7*24*3600,
+    # seconds between the budget checks of a running job
+    'trim_interval': 30
+}
+
 cutout_parameters = {
     'mip': 1,
     'pad': [256,256,4],
-    'prefix': os.path.join(workspace_prefix, "test_gtbot")
+    'prefix': os.path.join(workspace_prefix, "test_gtbot"),
+    # cutouts downloaded and written at the same time, overlapping cutouts are
+    # downloaded as their union unless it is bigger than max_union_cutouts
+    # cutouts, and the unions in flight hold at most in_flight_cutouts cutouts
+    'parallel': 4,
+    'max_union_cutouts': 2,
+    'in_flight_cutouts': 4,
+    # sections as png (with a zlib compress_level 0-9) or uncompressed tif
+    'extension': 'png',
+    'compress_level': 1,
+    # write the section stack in raw/, and/or the whole cutout as raw.h5
+    'stack': True,
+    'volume': False,
+    'cache': cache_parameters
+}
+
+worker_parameters = {
+    'upload': 1,
+    'download': 1,
+    'createbbox': 1,
+    # address space limit in bytes for every worker process, None for no limit
+    'memory_limit': None
+}
+
+scheduler_parameters = {
+    # voxels per second one worker gets through, used for the start time estimates
+    'throughput': {
+        'upload': 2000000,
+        'download': 5000000,
+        'createbbox': 20000000
+    },
+    # seconds after which a queued job goes ahead of everything else
+    'max_wait': 3600,
+    # sqlite file keeping the queued jobs and their checkpoints across restarts
+    'db_path': os.path.join(os.path.expanduser("~"), ".cache", "gtbot", "jobs.db"),
+    # times a job is started before a restart gives up on it
+    'max_attempts': 3,
+    # seconds a slack event is remembered to drop its redeliveries
+    'dedup_window': 600
+}
+
+upload_parameters = {
+    'decode_workers': -1,
+    'stream_depth': None,
+    # the CPUs are split between the upload workers
+    'parallel': max(1, mp.cpu_count() // worker_parameters['upload']),
+    'local_mips': 0,
+    'chunk_size': None,
+    'image_encoding': None,
+    'seg_encoding': None,
+    'mesh_lod': 0,
+    'revision': False
 }
 
 bbox_parameters = {
     'dim': [2944,2944,111],
-    'size_threshold': 8000
+    'size_threshold': 8000,
+    # put the segment points at the voxel farthest from the segment boundary
+    'interior_points': False,
+    # segmentation of bboxes up to merge_gap voxels apart is downloaded as their union,
+    # unless it is bigger than max_union_boxes bboxes, by parallel threads holding at
+    # most in_flight_boxes bboxes of segmentation at a time (the worker memory bound)
+    'merge_gap': 256,
+    'max_union_boxes': 2,
+    'parallel': 2,
+    'in_flight_boxes': 2,
+    'cache': cache_parameters
 }
 
+seen_events = {}
+seen_lock = threading.Lock()
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 gen=Fortunate("fortune.dat")
@@ -61,6 +137,20 @@ def format_cmd(msg):
     return msg.replace(botid, '').strip().lstrip(string.punctuation).strip()
 
 
+def parse_options(arg):
+    """Split trailing key=value options (e.g. seg_encoding=raw) off a command argument"""
+    options = {}
+    m = re.search(r"\s+(\w+)=(\S+)\s*$", arg)
+    while m is not None:
+        try:
+            options[m[1]] = json.loads(m[2])
+        except ValueError:
+            options[m[1]] = m[2]
+        arg = arg[:m.start()]
+        m = re.search(r"\s+(\w+)=(\S+)\s*$", arg)
+    return arg, options
+
+
 def load_metadata(path):
     json_names = ["metadata.json", "README.md", "raw/README.md"]
     parent = os.path.split(path)[0]
@@ -79,65 +169,107 @@ def load_metadata(path):
     return None
 
 
-def handle_upload(q):
-    while True:
-        logger.debug("check queue")
-        if q.qsize() == 0:
-            time.sleep(1)
-            continue
-        logger.debug("get message from queue")
-        d = q.get()
-        cmd = format_cmd(d['text'])
+def prepare_upload(d):
+    """Resolve the path, bucket, metadata and parameters of an upload/save message
 
-        bucket = "gtbot"
-        m = re.match(cmd_list['upload'], cmd)
-        if m is None:
-            m = re.match(cmd_list['save'], cmd)
-            if m is not None:
-                bucket = "gtbot_perm"
-            else:
-                continue
+    Returns None (after telling the user why) if the dataset cannot be uploaded
+    """
+    cmd = format_cmd(d['text'])
 
-        print(m[1])
-        path = guess_path(m[1])
-        if path is not None:
-            reply(d, "Start uploading and meshing dataset: {}".format(m[1]))
+    bucket = "gtbot"
+    m = re.match(cmd_list['upload'], cmd)
+    if m is None:
+        m = re.match(cmd_list['save'], cmd)
+        if m is not None:
+            bucket = "gtbot_perm"
         else:
-            reply(d, "Cannot find the path: {}".format(m[1]), broadcast=True)
-            continue
+            return None
+
+    print(m[1])
+    src, options = parse_options(m[1])
+    path = guess_path(src)
+    if path is None:
+        reply(d, "Cannot find the path: {}".format(src), broadcast=True)
+        return None
+    metadata = load_metadata(path)
+    if metadata is None:
+        path = path+"/export"
         metadata = load_metadata(path)
-        if metadata is None:
-            path = path+"/export"
-            metadata = load_metadata(path)
-
-        if metadata is None:
-            reply(d, "Cannot load metadata, cannot upload", broadcast=True)
-            continue
-        print(json.dumps(metadata, indent=2))
-
-        try:
-            #fortune = gen()
-            reply(d, "```{}```".format(gen_quote()), broadcast=True)
-            #page = wikipedia.page(wikipedia.random())
-            #reply(d, "{}".format(page.url), broadcast=True)
-        except Exception:
-            pass
 
+    if metadata is None:
+        reply(d, "Cannot load metadata, cannot upload", broadcast=True)
+        return None
+    print(json.dumps(metadata, indent=2))
+    # defaults < metadata "upload" section < options in the command
+    parameters = dict(upload_parameters)
+    for source, opts in [("metadata", metadata.get('upload', {})), ("command", options)]:
+        error = check_upload_options(opts)
+        if error is not None:
+            reply(d, "{} in the {}".format(error, source), broadcast=True)
+            return None
+        parameters.update(opts)
+    return {
+        'src': src,
+        'path': path,
+        'bucket': bucket,
+        'metadata': metadata,
+        'parameters': parameters
+    }
+
+
+def handle_upload(scheduler):
+    while True:
+        logger.debug("wait for an upload job")
+        job = scheduler.next_job('upload')
+        d = job['payload']['handle']
+        resume = job.get('checkpoint')
+        result = False
+        src = None
         try:
-            upload_dataset(d, path, bucket, metadata)
+            upload = prepare_upload(d)
+            if upload is not None:
+                src = upload['src']
+                if resume is None:
+                    reply(d, "Start uploading and meshing dataset: {}".format(src))
+                else:
+                    reply(d, "Resume uploading and meshing dataset: {}".format(src))
+
+                try:
+                    #fortune = gen()
+                    reply(d, "```{}```".format(gen_quote()), broadcast=True)
+                    #page = wikipedia.page(wikipedia.random())
+                    #reply(d, "{}".format(page.url), broadcast=True)
+                except Exception:
+                    pass
+
+                result = upload_dataset(d, upload['path'], upload['bucket'], upload['metadata'], upload['parameters'],
+                                        checkpoint=lambda state: scheduler.checkpoint(job['id'], state), resume=resume)
         except Exception as e:
             reply(d, "Some error I cannot handle: {}".format(str(e)))
-            raise e
+            logger.exception("upload failed")
+        finally:
+            followers = scheduler.done(job['id'])
+        for f in followers:
+            if result:
+                reply(f, "done!\n{}".format(result))
+            else:
+                reply(f, "The upload of {} failed, see the thread of the first request".format(src or "the dataset"))
+
+
+def load_state(scheduler, job):
+    """Fetch the neuroglancer state of a download or createbbox job, None if it cannot be read"""
+    d = job['payload']['handle']
+    ng_payload = get_ng_payload(d, job['payload']['url'])
+    if ng_payload is not None:
+        # the job now works on this version of the state, see Scheduler.submit
+        scheduler.checkpoint(job['id'], {'stage': 'loaded'})
+    return ng_payload
 
 
-def handle_download(q):
+def handle_download(scheduler):
     while True:
-        if q.qsize() == 0:
-            time.sleep(1)
-            continue
-        d = q.get()
-        cmd = format_cmd(d['text'])
-        m = re.match(cmd_list['download'], cmd)
+        job = scheduler.next_job('download')
+        d = job['payload']['handle']
         try:
             fortune = gen()
             reply(d, "```{}```".format(fortune.strip()), broadcast=True)
@@ -145,23 +277,135 @@ def handle_download(q):
             #reply(d, "{}".format(page.url), broadcast=True)
         except Exception:
             pass
+        result = None
         try:
-            reply(d, "Creating cutouts for ground truthing")
-            parse_nglink(d, m[1], cutout_parameters)
+            ng_payload = load_state(scheduler, job)
+            if ng_payload is not None:
+                reply(d, "Creating cutouts for ground truthing")
+                result = parse_nglink(d, job['payload']['url'], cutout_parameters, ng_payload)
         except Exception as e:
             reply(d, "Some error I cannot handle: {}".format(str(e)))
             pass
+        finally:
+            followers = scheduler.done(job['id'])
+        for f in followers:
+            if result:
+                reply(f, "done!\n{}".format("".join(result)))
+            else:
+                reply(f, "No cutouts were created, see the thread of the first request")
 
-def process_bbox(payload):
-    cmd = format_cmd(payload['text'])
-    m = re.match(cmd_list['createbbox'], cmd)
+
+def format_eta(seconds):
+    if seconds < 60:
+        return "right away"
+    if seconds < 3600:
+        return "in about {} min".format(int(seconds // 60))
+    return "in about {:.1f} h".format(seconds / 3600)
+
+
+def duplicate_event(body):
+    """True if the event was already seen within the dedup window (slack redelivers unacknowledged events)"""
+    d = body['event']
+    keys = [body.get('event_id'), "{}:{}".format(d.get('channel'), d.get('ts'))]
+    now = time.time()
+    with seen_lock:
+        for k in list(seen_events):
+            if now - seen_events[k] > scheduler_parameters['dedup_window']:
+                del seen_events[k]
+        if any(k in seen_events for k in keys if k is not None):
+            return True
+        for k in keys:
+            if k is not None:
+                seen_events[k] = now
+    return False
+
+
+def estimate_job(kind, payload):
+    """Voxels the job processes, None (after telling the user why) if it cannot run"""
+    d = payload['handle']
+    if kind == 'upload':
+        upload = prepare_upload(d)
+        if upload is None:
+            return None
+        return estimate_upload(upload['path'], upload['metadata'])
+    ng_payload = get_ng_payload(d, payload['url'])
+    if ng_payload is None:
+        return None
+    if kind == 'download':
+        return estimate_cutouts(ng_payload, cutout_parameters)
+    return estimate_bboxes(ng_payload, bbox_parameters)
+
+
+def release_job(job_id, kind, label, payload):
+    """Estimate the cost of a held job, which lets the scheduler start it, and report its place in the queue"""
+    d = payload['handle']
+    cost = None
     try:
-        reply(payload, "Convert point annotations to bboxes")
-        url = convert_pt_to_bbox(payload, m[2], bbox_parameters)
-        reply(payload, url)
+        cost = estimate_job(kind, payload)
     except Exception as e:
-        reply(payload, "Some error I cannot handle: {}".format(str(e)))
-        pass
+        reply(d, "Some error I cannot handle: {}".format(str(e)))
+        logger.exception("cannot estimate the {} task".format(label))
+    if cost is None:
+        for f in scheduler.done(job_id):
+            reply(f, "The {} task was dropped, see the thread of the first request".format(label))
+        return
+    scheduler.update_cost(job_id, cost)
+    status = scheduler.status(job_id)
+    if status is None:
+        reply(d, "Add {} task, starting now".format(label))
+        return
+    position, eta = status
+    reply(d, "Add {} task, position {} in the queue, expected to start {}".format(label, position, format_eta(eta)))
+
+
+def submit_job(d, kind, label, payload, key=None):
+    """Queue a job held until its cost is known, the data is read by a thread so the event is acknowledged in time"""
+    job_id, coalesced = scheduler.submit(kind, d.get('user'), None, payload, key, d)
+    if coalesced:
+        reply(d, "The same {} task is already queued or running, I will post its result here".format(label))
+        return
+    threading.Thread(target=release_job, args=(job_id, kind, label, payload), daemon=True).start()
+
+
+def run_worker(target, scheduler, memory_limit=None, profiles=None):
+    if memory_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    if profiles is not None:
+        set_profile_cache(profiles)
+    target(scheduler)
+
+
+def start_workers(target, scheduler, n, profiles=None):
+    workers = []
+    for _ in range(n):
+        p = mp.Process(target=run_worker, args=(target, scheduler, worker_parameters['memory_limit'], profiles))
+        p.start()
+        workers.append(p)
+    return workers
+
+
+def handle_bbox(scheduler):
+    while True:
+        job = scheduler.next_job('createbbox')
+        d = job['payload']['handle']
+        url = None
+        try:
+            ng_payload = load_state(scheduler, job)
+            if ng_payload is not None:
+                reply(d, "Convert point annotations to bboxes")
+                url = convert_pt_to_bbox(d, job['payload']['url'], bbox_parameters, ng_payload)
+                reply(d, url)
+        except Exception as e:
+            reply(d, "Some error I cannot handle: {}".format(str(e)))
+            pass
+        finally:
+            followers = scheduler.done(job['id'])
+        for f in followers:
+            if url:
+                reply(f, url)
+            else:
+                reply(f, "No bboxes were created, see the thread of the first request")
 
 
 @app.event({"type": "message"})
@@ -169,51 +413,70 @@ def handle_cmd(body: dict):
     d = body['event']
     logger.debug(d)
     if relevant_msg(d):
+        if duplicate_event(body):
+            logger.info("drop redelivered event {}".format(body.get('event_id')))
+            return
         cmd = format_cmd(d['text'])
         logger.debug("try to match cmd")
-        m = re.match(cmd_list['upload'], cmd)
-        if m is not None:
-            q_up.put(d)
-            reply(d, "Add upload task, {} task(s) in the queue at this moment".format(q_up.qsize()))
-            return
-
-        m = re.match(cmd_list['save'], cmd)
-        if m is not None:
-            q_up.put(d)
-            reply(d, "Add save task, {} task(s) in the queue at this moment".format(q_up.qsize()))
-            return
+        for label in ['upload', 'save']:
+            m = re.match(cmd_list[label], cmd)
+            if m is not None:
+                # same dataset into the same bucket with the same options
+                src, options = parse_options(m[1])
+                key = json.dumps([label, dataset_key(src), options], sort_keys=True)
+                submit_job(d, 'upload', label, {'handle': d}, key)
+                return
 
         m = re.match(cmd_list['download'], cmd)
         if m is not None:
-            q_down.put(d)
-            reply(d, "Add download task, {} task(s) in the queue at this moment".format(q_down.qsize()))
+            # the cutouts are written under the name of the user
+            key = json.dumps(['download', d.get('user'), m[1]])
+            submit_job(d, 'download', 'download', {'handle': d, 'url': m[1]}, key)
             return
 
         m = re.match(cmd_list['createbbox'], cmd)
         if m is not None:
-            process_bbox(d)
+            key = json.dumps(['createbbox', m[2]])
+            submit_job(d, 'createbbox', 'createbbox', {'handle': d, 'url': m[2]}, key)
             return
 
         reply(d, "sorry, I do not understand the message")
 
 def hello_world():
-    client = WebClient(token=slack_token)
+    client = slack_client()
 
     client.chat_postMessage(
         channel='#seuron-alerts',
         text="gtbot rebooted at {}!".format(os.uname()[1]))
 
 
+SchedulerManager.register('TTLCache', TTLCache)
+
+
 if __name__ == '__main__':
-    q_up = mp.Queue()
-    q_down = mp.Queue()
-    p_up = mp.Process(target=handle_upload, args=(q_up,))
-    p_down = mp.Process(target=handle_download, args=(q_down,))
-    p_up.start()
-    p_down.start()
+    manager = SchedulerManager()
+    manager.start()
+    scheduler = manager.Scheduler({k: worker_parameters[k] for k in ['upload', 'download', 'createbbox']},
+                                  scheduler_parameters['throughput'], scheduler_parameters['max_wait'],
+                                  scheduler_parameters['db_path'], scheduler_parameters['max_attempts'])
+    for job in scheduler.dropped_jobs():
+        reply(job['payload']['handle'], "gtbot stopped {} times while running your {} task, giving up on it".format(
+            job['attempts'], job['kind']))
+    # user profiles are cached once for the bot and all its workers
+    profiles = manager.TTLCache(PROFILE_TTL, PROFILE_CACHE_SIZE)
+    set_profile_cache(profiles)
+    for job in scheduler.resumed_jobs():
+        reply(job['payload']['handle'], "gtbot restarted, your {} task is back in the queue".format(job['kind']))
+        if job['cost'] is None:
+            # its cost was still being estimated when the bot stopped
+            threading.Thread(target=release_job, args=(job['id'], job['kind'], job['kind'], job['payload']),
+                             daemon=True).start()
+    workers = start_workers(handle_upload, scheduler, worker_parameters['upload'], profiles)
+    workers += start_workers(handle_download, scheduler, worker_parameters['download'], profiles)
+    workers += start_workers(handle_bbox, scheduler, worker_parameters['createbbox'], profiles)
     handler = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
     handler.start()
     print("starting the bot")
     hello_world()
-    p_up.join()
-    p_down.join()
+    for p in workers:
+        p.join()
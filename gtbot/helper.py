@@ -4,19 +4,156 @@ import urllib
 import requests
 import json
 from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
 import os
 import re
+import time
+import queue
+import inspect
+import atexit
+import threading
 import ntpath
+import posixpath
+import fcntl
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from bot_info import slack_token, oauth_token, workspace_prefix
 
+# seconds batched replies of a thread are collected before they are posted
+REPLY_INTERVAL = 5
+# most lines merged into one batched reply
+REPLY_BATCH = 50
+# seconds between two posts, slack allows about one message per second
+POST_INTERVAL = 1
+
+# seconds a user profile is cached, and most profiles kept
+PROFILE_TTL = 3600
+PROFILE_CACHE_SIZE = 1024
+
+# states saved in the state service never change, only those are cached
+NGLSTATE_HOST = "https://globalv1.daf-apis.com/nglstate/"
+NGLSTATE_POST = NGLSTATE_HOST + "post"
+NGLSTATE_LINK = "https://neuromancer-seung-import.appspot.com/?json_url={}"
+# (connect, read) timeouts in seconds and retries of the state service calls
+STATE_TIMEOUT = (10, 60)
+STATE_RETRIES = 3
+# seconds a fetched state is cached, and most states kept
+STATE_TTL = 24*3600
+STATE_CACHE_SIZE = 256
+
+_slack = {'pid': None, 'client': None, 'queue': None}
+_slack_lock = threading.Lock()
+
 
 def safe_string(s):
     keepcharacters = (' ','.','_','-')
     return "".join(c if c.isalnum() or c in keepcharacters else "_" for c in s ).rstrip()
 
 
-def reply(data, msg, broadcast=False):
+def slack_client():
+    """The WebClient shared by everything in this process"""
+    with _slack_lock:
+        if _slack['pid'] != os.getpid():
+            # threads and connections do not survive a fork, start over in a new process
+            _slack['pid'] = os.getpid()
+            _slack['client'] = WebClient(token=slack_token)
+            _slack['queue'] = None
+        return _slack['client']
+
+
+def reply_queue():
+    """Queue of the background sender of this process, the sender is started on first use"""
+    client = slack_client()
+    with _slack_lock:
+        if _slack['queue'] is None:
+            _slack['queue'] = queue.Queue()
+            t = threading.Thread(target=reply_sender, args=(client, _slack['queue']), daemon=True)
+            t.start()
+        return _slack['queue']
+
+
+def post_message(client, msg, last_post):
+    """Post one message, waiting out the rate limit, returns the time it was posted"""
+    for _ in range(5):
+        wait = last_post + POST_INTERVAL - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            client.chat_postMessage(
+                channel=msg['channel'],
+                thread_ts=msg['ts'],
+                unfurl_links=True,
+                reply_broadcast=msg['broadcast'],
+                text="<@{}>, {}".format(msg['user'], msg['text']),
+            )
+            return time.time()
+        except SlackApiError as e:
+            if e.response.status_code != 429:
+                print("cannot post message: {}".format(e))
+                return time.time()
+            last_post = time.time() + int(e.response.headers.get('Retry-After', 1))
+        except Exception as e:
+            print("cannot post message: {}".format(e))
+            return time.time()
+    print("give up posting message: {}".format(msg['text']))
+    return time.time()
+
+
+def reply_sender(client, q):
+    """Post the queued replies in order, merging the batched ones of each thread"""
+    batches = OrderedDict()
+    last_post = 0
+    while True:
+        timeout = None
+        if batches:
+            timeout = max(0, min(b['since'] for b in batches.values()) + REPLY_INTERVAL - time.time())
+        try:
+            item = q.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+        now = time.time()
+        posts = []
+        if item is not None and item.get('batch'):
+            b = batches.setdefault((item['channel'], item['ts']), {'since': now, 'lines': []})
+            b['user'] = item['user']
+            b['lines'].append(item['text'])
+        # due batches, every batch on flush, and the pending batch of a thread before its next message
+        for k in list(batches):
+            if now - batches[k]['since'] >= REPLY_INTERVAL or (item is not None and (
+                    'flush' in item or (not item.get('batch') and k == (item.get('channel'), item.get('ts'))))):
+                b = batches.pop(k)
+                for i in range(0, len(b['lines']), REPLY_BATCH):
+                    posts.append({'channel': k[0], 'ts': k[1], 'user': b['user'], 'broadcast': False,
+                                  'text': "\n".join(b['lines'][i:i+REPLY_BATCH])})
+        if item is not None and 'text' in item and not item.get('batch'):
+            posts.append(item)
+        for msg in posts:
+            last_post = post_message(client, msg, last_post)
+        if item is not None:
+            q.task_done()
+
+
+def flush_replies():
+    """Block until every queued reply of this process is posted"""
+    with _slack_lock:
+        q = _slack['queue'] if _slack['pid'] == os.getpid() else None
+    if q is not None:
+        q.put({'flush': True})
+        q.join()
+
+
+atexit.register(flush_replies)
+
+
+def reply(data, msg, broadcast=False, batch=False):
+    """Reply in the thread of the message data, without waiting for slack
+
+    Replies are posted in order by a background sender. Batched replies
+    (e.g. one line per item) are merged into one message per thread every
+    REPLY_INTERVAL seconds.
+    """
     try:
         channel_id = data['channel']
         thread_ts = data['ts']
@@ -25,14 +162,54 @@ def reply(data, msg, broadcast=False):
         print(data)
         return
 
-    webclient = WebClient(token=slack_token)
-    webclient.chat_postMessage(
-        channel=channel_id,
-        thread_ts=thread_ts,
-        unfurl_links=True,
-        reply_broadcast=broadcast,
-        text="<@{}>, {}".format(user, msg),
-    )
+    reply_queue().put({
+        'channel': channel_id,
+        'ts': thread_ts,
+        'user': user,
+        'text': msg,
+        'broadcast': broadcast,
+        'batch': batch
+    })
+
+
+class TTLCache(object):
+    """Thread safe mapping whose entries expire after ttl seconds
+
+    At most maxsize entries are kept, the least recently used go first.
+    Served by the scheduler manager it is shared by all the workers.
+    """
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+_profiles = {'cache': TTLCache(PROFILE_TTL, PROFILE_CACHE_SIZE)}
+_states = {'pid': None, 'session': None, 'cache': TTLCache(STATE_TTL, STATE_CACHE_SIZE)}
+
+
+def set_profile_cache(cache):
+    """Use cache (e.g. a TTLCache shared through the manager) for the user profiles"""
+    _profiles['cache'] = cache
 
 
 def user_info(data, key):
@@ -41,10 +218,18 @@ def user_info(data, key):
     except (KeyError, ValueError, IndexError):
         print(data)
         return None
-    webclient = WebClient(token=slack_token)
-    rc = webclient.users_info(user=user)
+    cache = _profiles['cache']
+    profile = cache.get(user)
+    if profile is None:
+        rc = slack_client().users_info(user=user)
+        try:
+            profile = rc["user"]["profile"]
+        except KeyError:
+            print("cannot get the profile of {}".format(user))
+            return None
+        cache.set(user, profile)
     try:
-        return rc["user"]["profile"][key]
+        return profile[key]
     except KeyError:
         print("does not have key {} in the profile".format(key))
         return None
@@ -66,6 +251,18 @@ def extrac_bucket_path(path):
             return None
 
 
+def dataset_key(path):
+    """Path of a dataset inside the bucket, the same for its unix and windows forms
+
+    Only the string is looked at, nothing on the file system. Paths outside
+    the bucket are kept as they are, without trailing separators.
+    """
+    bucket_path = extrac_bucket_path(path)
+    if bucket_path is None:
+        return path.strip().rstrip("/\\")
+    return posixpath.normpath(bucket_path.strip()).strip("/")
+
+
 def create_bucket_url(local_path):
     bucket_path = extrac_bucket_path(local_path)
     if bucket_path is not None:
@@ -84,6 +281,219 @@ def guess_path(path):
 
     return None
 
+def state_session():
+    """The keep-alive requests session of this process for the state service"""
+    with _slack_lock:
+        if _states['pid'] != os.getpid():
+            # retry every method, the keyword was renamed in urllib3 1.26
+            if 'allowed_methods' in inspect.signature(Retry.__init__).parameters:
+                methods = {'allowed_methods': False}
+            else:
+                methods = {'method_whitelist': False}
+            retry = Retry(total=STATE_RETRIES, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                          **methods)
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(max_retries=retry))
+            session.mount("http://", HTTPAdapter(max_retries=retry))
+            if oauth_token:
+                session.headers['Authorization'] = 'Bearer {}'.format(oauth_token)
+            _states['pid'] = os.getpid()
+            _states['session'] = session
+        return _states['session']
+
+
+def fetch_state(json_url):
+    """Text of the neuroglancer state at json_url
+
+    States of the state service are immutable, so they are cached by url.
+    States hosted anywhere else can be edited and are always fetched.
+    """
+    cached = json_url.startswith(NGLSTATE_HOST)
+    text = _states['cache'].get(json_url) if cached else None
+    if text is None:
+        r = state_session().get(json_url, timeout=STATE_TIMEOUT)
+        r.raise_for_status()
+        text = r.text
+        if cached:
+            _states['cache'].set(json_url, text)
+    return text
+
+
+def post_state(payload):
+    """Save a neuroglancer state in the state service, returns its link"""
+    text = json.dumps(payload)
+    r = state_session().post(NGLSTATE_POST, data=text, timeout=STATE_TIMEOUT)
+    r.raise_for_status()
+    json_url = r.text.strip()[1:-1]
+    if json_url.startswith(NGLSTATE_HOST):
+        _states['cache'].set(json_url, text)
+    return NGLSTATE_LINK.format(json_url)
+
+
+class LockedVolume(object):
+    """CloudVolume whose reads hold a shared lock of its cache
+
+    CloudVolume lists the cached chunks before it reads them, trim_cache
+    takes the lock exclusively to evict, so a listed chunk is never evicted
+    before it is read (and zero filled as missing).
+    """
+    def __init__(self, cv, lock_fn):
+        object.__setattr__(self, 'cv', cv)
+        object.__setattr__(self, 'lock_fn', lock_fn)
+
+    def __getattr__(self, name):
+        return getattr(self.cv, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.cv, name, value)
+
+    def __getitem__(self, slices):
+        with open(self.lock_fn, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            return self.cv[slices]
+
+
+def cache_volume(path, cache, **kwargs):
+    """CloudVolume of path reading its chunks through the local disk cache
+
+    cache is a dict with the cache 'path' (None to read without one), see
+    trim_cache. CloudVolume keeps the chunks under the layer path and mip.
+    """
+    from cloudvolume import CloudVolume
+    if cache is None or not cache.get('path'):
+        return CloudVolume(path, **kwargs)
+    os.makedirs(cache['path'], exist_ok=True)
+    return LockedVolume(CloudVolume(path, cache=cache['path'], **kwargs), os.path.join(cache['path'], ".lock"))
+
+
+# time of the last trim_cache of every cache path by this process
+last_trim = {}
+
+
+def trim_cache(cache, min_interval=0):
+    """Evict the least recently used files until the cache fits in cache['max_bytes']
+
+    Files written more than cache['max_age'] seconds ago are evicted anyway,
+    however often they are read, so layers rewritten in place are not served
+    stale for long. Only one process trims at a time, the others skip, and
+    files are only removed while no LockedVolume is reading. Jobs call it
+    as they go with min_interval (cache['trim_interval']), which skips the
+    trim if this process trimmed the cache less than that many seconds ago.
+    """
+    if cache is None or not cache.get('path') or not os.path.isdir(cache['path']):
+        return
+    if time.time() - last_trim.get(cache['path'], 0) < min_interval:
+        return
+    last_trim[cache['path']] = time.time()
+    with open(os.path.join(cache['path'], ".trim"), 'a') as trimming:
+        try:
+            fcntl.flock(trimming, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        now = time.time()
+        files = []
+        total = 0
+        for root, _, names in os.walk(cache['path']):
+            for name in names:
+                if root == cache['path'] and name in (".lock", ".trim"):
+                    continue
+                fn = os.path.join(root, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                files.append((max(st.st_atime, st.st_mtime), st.st_mtime, st.st_size, fn))
+                total += st.st_size
+        expired = []
+        kept = []
+        for used, written, size, fn in files:
+            if now - written > cache.get('max_age', float('inf')):
+                expired.append((size, fn))
+            else:
+                kept.append((used, size, fn))
+        # least recently used first
+        kept.sort()
+        evict = list(expired)
+        left = total - sum(size for size, _ in expired)
+        for used, size, fn in kept:
+            if left <= cache['max_bytes']:
+                break
+            evict.append((size, fn))
+            left -= size
+        if not evict:
+            return
+        removed = 0
+        with open(os.path.join(cache['path'], ".lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for size, fn in evict:
+                try:
+                    os.remove(fn)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+        print("evicted {} files from the chunk cache, {} bytes left".format(removed, total))
+
+
+def touching(a, b, gap=0):
+    """True if the bboxes overlap, share a face or are at most gap voxels apart"""
+    return all(a.minpt[i] <= b.maxpt[i] + gap and b.minpt[i] <= a.maxpt[i] + gap for i in range(3))
+
+
+def merge_bboxes(bboxes, slack=1.5, gap=0, max_volume=None):
+    """Group overlapping or adjacent bboxes, returns [(union bbox, [indices of its members])]
+
+    Two groups are only merged if their union has at most slack times
+    their voxels, so bboxes touching at a corner do not pull in a big
+    empty region, and at most max_volume voxels. Bboxes up to gap voxels
+    apart count as adjacent.
+    """
+    from cloudvolume.lib import Bbox
+    groups = [(Bbox.from_list(b.to_list()), [i]) for i, b in enumerate(bboxes)]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i+1, len(groups)):
+                a, b = groups[i][0], groups[j][0]
+                if not touching(a, b, gap):
+                    continue
+                union = Bbox.expand(a, b)
+                if union.volume() > slack * (a.volume() + b.volume()):
+                    continue
+                if max_volume is not None and union.volume() > max_volume:
+                    continue
+                groups[i] = (union, groups[i][1] + groups[j][1])
+                del groups[j]
+                merged = True
+                break
+            if merged:
+                break
+    return groups
+
+
+def map_bounded(fn, items, sizes, parallel, budget):
+    """[fn(item) for item in items] run by up to parallel threads
+
+    A new item is only started while the sizes (e.g. voxels) of the running
+    ones stay within budget, so the memory in flight is bounded. An item
+    bigger than the budget runs alone.
+    """
+    results = [None] * len(items)
+    todo = list(range(len(items)))
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        while todo or running:
+            while todo and len(running) < parallel and \
+                    (not running or sum(sizes[i] for i in running.values()) + sizes[todo[0]] <= budget):
+                i = todo.pop(0)
+                running[executor.submit(fn, items[i])] = i
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for f in done:
+                results[running.pop(f)] = f.result()
+    return results
+
+
 def get_ng_payload(handle, url):
     try:
         components = urllib.parse.urlparse(url)
@@ -96,99 +506,236 @@ def get_ng_payload(handle, url):
         payload = ""
         if len(components.fragment) == 0:
             json_url = components.query.replace('json_url=','')
-            if oauth_token:
-                headers = {'Authorization': 'Bearer {}'.format(oauth_token)}
-                r = requests.get(json_url, headers=headers)
-            else:
-                r = requests.get(json_url)
-            payload = r.text
+            payload = fetch_state(json_url)
         else:
             payload = urllib.parse.unquote(components.fragment)[1:]
         data = json.loads(payload, object_pairs_hook=OrderedDict)
         return data
-    except (ValueError, KeyError):
+    except (ValueError, KeyError, requests.RequestException):
         reply(handle, "Cannot read json payload from the neuroglancer link: {}".format(url), broadcast=False)
         return None
 
 
-def load_image(src_path):
+def pack_rgb(img, out=None):
+  """Pack an RGB section into uint32 segment ids (R<<16 | G<<8 | B)
+
+  The channels are written byte by byte through a uint8 view of the output,
+  so no intermediate planes are allocated.
+  """
+  if out is None:
+    out = np.empty(img.shape[:2], dtype=np.uint32)
+  rgba = out.view(np.uint8).reshape(out.shape + (4,))
+  rgba[:, :, :3] = img[:, :, 2::-1]
+  rgba[:, :, 3] = 0
+  return out
+
+
+def load_image(src_path, out=None, box=None):
   """Open TIF image and convert to numpy ndarray of dtype
 
   Currently tested for only for uint8 -> uint8, uint32 or uint24 -> uint32
 
   Args:
   	src_path: full path of the image
+  	out: optional C-contiguous 2d array the section is decoded into
+  	box: optional (left, upper, right, lower) pixel box to crop the section to
 
   Returns:
   	An ndarray of dtype
   """
-  img = np.array(Image.open(src_path))
+  img = Image.open(src_path)
+  if box is not None:
+    img = img.crop(box)
+  img = np.asarray(img)
   if len(img.shape) == 3:
-    img = np.dstack((np.zeros(img.shape[:2]+(1,)), img))
-    img = img[:,:, ::-1]
-    img = img.astype(np.uint8).view(np.uint32)
-    img = img.reshape(img.shape[:2])
-    return img.astype(np.uint32)
-  else:
+    return pack_rgb(img, out)
+  if out is None:
     return img.astype(np.uint8)
+  out[...] = img
+  return out
 
 
-def load_from_dir(src_dir, extension='tif'):
-  """Assume directory contains only the images to be stored
+def dir_slabs(src_dir, extension='tif', n_workers=-1, crop=None, slab_depth=None):
+  """Yield (zslice, {layer: array}) slabs of an image stack along z
+
+  The first section fixes the shape and dtype, each slab is one preallocated
+  x,y,z array with every section decoded straight into its own z-plane.
+  Sections are decoded by n_workers threads (PIL releases the GIL while
+  decoding), so nothing is pickled between processes. zslice is relative to
+  the (cropped) stack, slab_depth=None yields the whole stack as one slab.
+
+  If crop (x, y, z slices) is given, sections outside the z range are never
+  opened and the others are cropped to the x, y range before conversion.
   """
   from joblib import Parallel, delayed
-  files = os.listdir(src_dir)
-  files.sort()
-  imgs = Parallel(n_jobs=-1)(delayed(load_image)(os.path.join(src_dir, fn)) for fn in files if fn.endswith(extension))
-  #for fn in files:
-  #  if fn.endswith(extension):
-  #    imgs.append(load_image(os.path.join(src_dir, fn)))
-  if imgs[0].dtype == np.uint8:
-    return {'uploaded_image': np.asarray(imgs).transpose(2,1,0)}
-  return {'seg': np.asarray(imgs).transpose(2,1,0)}
-
-
-def load_from_omni_h5(fn):
+  files = sorted(fn for fn in os.listdir(src_dir) if fn.endswith(extension))
+  box = None
+  if crop is not None:
+    xslice, yslice, zslice = crop
+    files = files[zslice]
+    box = (xslice.start, yslice.start, xslice.stop, yslice.stop)
+  if len(files) == 0:
+    return
+  first = load_image(os.path.join(src_dir, files[0]), box=box)
+  layer = 'uploaded_image' if first.dtype == np.uint8 else 'seg'
+  depth = slab_depth if slab_depth else len(files)
+
+  for z in range(0, len(files), depth):
+    zslice = slice(z, min(z+depth, len(files)))
+    data = np.empty(first.shape[::-1] + (zslice.stop - zslice.start,), dtype=first.dtype, order='F')
+
+    def load_section(k):
+      load_image(os.path.join(src_dir, files[zslice.start+k]), out=data[:, :, k].T, box=box)
+
+    start = 0
+    if z == 0:
+      data[:, :, 0] = first.T
+      start = 1
+    Parallel(n_jobs=n_workers, require='sharedmem')(delayed(load_section)(k) for k in range(start, data.shape[2]))
+    yield zslice, {layer: data}
+    # drop the slab before the next one is allocated, the caller holds the only reference
+    del data
+
+
+def load_from_dir(src_dir, extension='tif', n_workers=-1, crop=None):
+  """Assume directory contains only the images to be stored
+
+  Loads the whole (cropped) stack as a single slab, see dir_slabs
+  """
+  for _, data in dir_slabs(src_dir, extension, n_workers=n_workers, crop=crop):
+    return data
+  return None
+
+
+OMNI_TYPES = {
+    'working': 1,
+    'valid': 2,
+    'uncertain': 3
+}
+
+#OMNI_TYPES = {
+#    'soma': 1,
+#    'axon': 2,
+#    'dendrite': 3,
+#    'glia': 5
+#}
+
+
+def omni_type_lut(seg_type):
+    """Turn the segment -> omni type dict into sorted lookup arrays"""
+    keys = np.array(sorted(seg_type), dtype=np.uint64)
+    vals = np.array([seg_type[k] for k in sorted(seg_type)], dtype=np.uint8)
+    return keys, vals
+
+
+def classify_omni_types(seg, lut):
+    """Label every voxel with its omni type (0 for unlisted segments)
+
+    Uses a binary search against the sorted segment ids, so the whole array is
+    classified in one vectorized pass without sorting the voxels.
+    """
+    keys, vals = lut
+    if len(keys) == 0:
+        return np.zeros(seg.shape, dtype=np.uint8)
+    keys = keys.astype(seg.dtype)
+    idx = np.searchsorted(keys, seg)
+    np.minimum(idx, len(keys)-1, out=idx)
+    types = vals[idx]
+    types[keys[idx] != seg] = 0
+    return types
+
+
+def h5_volume_shape(dset):
+    """Shape of the HDF5 dataset after dropping singleton axes, like np.squeeze"""
+    return tuple(s for s in dset.shape if s != 1)
+
+
+def h5_zyx_index(dset, zslice, yslice=slice(None), xslice=slice(None)):
+    """Index tuple selecting a z,y,x hyperslab of a (possibly unsqueezed) dataset"""
+    slices = [zslice, yslice, xslice]
+    idx = []
+    for s in dset.shape:
+        if s == 1:
+            idx.append(0)
+        else:
+            idx.append(slices.pop(0))
+    return tuple(idx)
+
+
+def omni_h5_slabs(fn, slab_depth=32, crop=None, out=None):
+    """Yield (zslice, {layer: array}) slabs of an omni/VAST HDF5 export
+
+    The `main` dataset is read slab_depth sections at a time as x,y,z arrays,
+    so the temporaries never exceed one slab. If segments.txt is present, the
+    'working', 'valid' and 'uncertain' layers are filled from the same slab
+    with one lookup per voxel. zslice is relative to the (cropped) volume.
+
+    If crop (x, y, z slices) is given, only that hyperslab is read from disk.
+    If out is a dict, it is filled with the full-size layers and the yielded
+    slabs are views into them.
+    """
     import h5py
-    import numpy as np
-    omni_types = {
-        'working': 1,
-        'valid': 2,
-        'uncertain': 3
-    }
-
-    #omni_types = {
-    #    'soma': 1,
-    #    'axon': 2,
-    #    'dendrite': 3,
-    #    'glia': 5
-    #}
     dirpath = os.path.split(fn)[0]
-    with h5py.File(fn,"r") as f:
-        data = np.squeeze(np.array(f['main'])).transpose(2,1,0)
-        if len(data.shape) > 3:
-            print("only support 3 dimensional dataset")
-            return None
-        if data.dtype == np.uint8 or data.dtype == np.float32:
-            return {'raw_image': data}
     try:
         seg_type = np.loadtxt(os.path.join(dirpath, "segments.txt"), dtype=(int,int), delimiter=',', skiprows=2)
         #seg_type = np.loadtxt(os.path.join(dirpath, "segments.txt"), dtype=(int,int), delimiter=',')
+        lut = omni_type_lut(dict(seg_type))
     except IOError:
-        return {'seg': data.astype(np.uint32)}
-
-    seg_data = {'seg': data.astype(np.uint32)}
-    #seg_data = dict()
-    seg_type = dict(seg_type)
-    for k in omni_types:
-        print("process omni type: {}".format(k))
-        seg = np.copy(data)
-        fltr = np.vectorize(lambda x: True if x not in seg_type or seg_type[x] != omni_types[k] else False)
-        mask = fltr(seg)
-        seg[mask] = 0
-        seg_data[k] = seg.astype(np.uint32)
+        lut = None
 
-    return seg_data
+    with h5py.File(fn,"r") as f:
+        dset = f['main']
+        shape = h5_volume_shape(dset)
+        if len(shape) != 3:
+            print("only support 3 dimensional dataset")
+            return
+        crop = crop if crop is not None else (slice(None),)*3
+        xslice, yslice, zslice = [slice(*c.indices(s)) for c, s in zip(crop, shape[::-1])]
+        size = tuple(max(c.stop - c.start, 0) for c in (xslice, yslice, zslice))
+        if dset.dtype == np.uint8 or dset.dtype == np.float32:
+            main_layer = 'raw_image'
+            layers = {main_layer: dset.dtype}
+            lut = None
+        else:
+            main_layer = 'seg'
+            layers = {main_layer: np.uint32}
+            if lut is not None:
+                for k in OMNI_TYPES:
+                    layers[k] = np.uint32
+        if out is not None:
+            for k in layers:
+                out[k] = np.zeros(size, dtype=layers[k], order='F')
+
+        depth = slab_depth if slab_depth else size[2]
+        for z in range(0, size[2], depth):
+            slab_slice = slice(z, min(z+depth, size[2]))
+            src_slice = slice(zslice.start + slab_slice.start, zslice.start + slab_slice.stop)
+            if out is not None:
+                data = {k: out[k][:, :, slab_slice] for k in layers}
+            else:
+                data = {k: np.zeros(size[:2] + (slab_slice.stop - slab_slice.start,), dtype=layers[k], order='F') for k in layers}
+            slab = data[main_layer]
+            slab[...] = dset[h5_zyx_index(dset, src_slice, yslice, xslice)].transpose(2,1,0)
+            if lut is not None:
+                print("process omni types in sections {}-{}".format(src_slice.start, src_slice.stop))
+                types = classify_omni_types(slab, lut)
+                for k in OMNI_TYPES:
+                    np.copyto(data[k], slab, where=(types == OMNI_TYPES[k]))
+                del types
+            yield slab_slice, data
+            # drop the slab before the next one is allocated, the caller holds the only reference
+            del data, slab
+
+
+def load_from_omni_h5(fn, slab_depth=32, crop=None):
+    """Load an omni/VAST HDF5 export into preallocated x,y,z arrays
+
+    See omni_h5_slabs, the slabs are written into the full-size layers
+    """
+    data = {}
+    for _ in omni_h5_slabs(fn, slab_depth, crop=crop, out=data):
+        pass
+    return data if data else None
 
 
 def draw_bounding_cube(img, bbox, val=255, thickness=1):
@@ -202,13 +749,32 @@ def draw_bounding_cube(img, bbox, val=255, thickness=1):
     img[:, maxpt.y+t,  z_slice] = val
 
 
-def write_to_dir(dst_dir, img, extension='tif'):
+def write_to_dir(dst_dir, img, extension='tif', n_workers=-1, compress_level=None):
     """Split 3d ndimgay along z dim into 2d sections & save as tifs
+
+    Sections are encoded and written by n_workers threads. compress_level
+    (0-9) sets the zlib level of png sections, tifs are written uncompressed.
     """
-    for k in range(img.shape[2]):
+    from joblib import Parallel, delayed
+    options = {}
+    if extension == 'png' and compress_level is not None:
+      options['compress_level'] = compress_level
+
+    def write_section(k):
       fn = os.path.join(dst_dir, '{0:03d}.{1}'.format(k+1, extension))
-      print('Writing {0}'.format(fn))
       arr = Image.fromarray(img[:,:,k].T)
-      arr.save(fn)
+      arr.save(fn, **options)
+
+    print('Writing {0} sections to {1}'.format(img.shape[2], dst_dir))
+    Parallel(n_jobs=n_workers, require='sharedmem')(delayed(write_section)(k) for k in range(img.shape[2]))
+
+
+def write_to_h5(fn, img, chunks=(256, 256, 16), compression='gzip'):
+    """Save a 3d x,y,z array as one chunked, compressed hdf5 dataset 'main' in z,y,x order"""
+    import h5py
+    data = img.T
+    chunks = tuple(min(c, s) for c, s in zip(chunks[::-1], data.shape))
+    with h5py.File(fn, 'w') as f:
+      f.create_dataset('main', data=data, chunks=chunks, compression=compression)
 
 
@@ -0,0 +1,68 @@
+"""
+Revision history for incremental re-uploads
+
+Every dataset uploaded in revision mode remembers its layers and a hash
+of every base mip chunk in a small json file next to its metadata.json,
+so the next upload of the same dataset only rewrites the changed chunks.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+
+REVISION_FILE = ".gtbot_revisions.json"
+
+
+def revision_file(path):
+    return os.path.join(os.path.split(os.path.normpath(path))[0], REVISION_FILE)
+
+
+def revision_key(path, bucket):
+    return "{}:{}".format(bucket, os.path.normpath(path))
+
+
+def read_revisions(path):
+    try:
+        with open(revision_file(path)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def load_revision(path, bucket):
+    """Last revision uploaded from path into bucket, None if there is none"""
+    return read_revisions(path).get(revision_key(path, bucket))
+
+
+def save_revision(path, bucket, revision):
+    fn = revision_file(path)
+    revisions = read_revisions(path)
+    revisions[revision_key(path, bucket)] = revision
+    tmp_fn = fn + ".tmp"
+    with open(tmp_fn, 'w') as f:
+        json.dump(revisions, f)
+    os.replace(tmp_fn, fn)
+
+
+def chunk_hashes(data, chunk_size, z_offset=0):
+    """{chunk key: digest} for every chunk of a slab starting at section z_offset
+
+    Keys are the chunk grid indices relative to the first voxel of the volume.
+    """
+    hashes = {}
+    cx, cy, cz = chunk_size
+    for x in range(0, data.shape[0], cx):
+        for y in range(0, data.shape[1], cy):
+            for z in range(0, data.shape[2], cz):
+                chunk = np.ascontiguousarray(data[x:x+cx, y:y+cy, z:z+cz])
+                key = "{}_{}_{}".format(x//cx, y//cy, (z_offset+z)//cz)
+                hashes[key] = hashlib.sha1(chunk).hexdigest()
+    return hashes
+
+
+def chunk_slices(key, chunk_size, z_offset=0):
+    """Slices of the chunk key inside a slab starting at section z_offset"""
+    idx = [int(i) for i in key.split("_")]
+    start = [i*c for i, c in zip(idx, chunk_size)]
+    start[2] -= z_offset
+    return tuple(slice(s, s+c) for s, c in zip(start, chunk_size))
@@ -0,0 +1,219 @@
+"""
+Cost-aware fair scheduling of the queued gtbot jobs
+
+One Scheduler lives in a manager process and is shared by the slack
+handler (which submits jobs) and the worker processes (which take them).
+Jobs and their stage checkpoints are kept in a sqlite database, so the
+queue survives a restart and interrupted jobs resume where they stopped.
+Jobs submitted with the key of a queued or running job are coalesced into
+it, the later requests just follow it and get its result. A job submitted
+without a cost is held back until its cost is estimated.
+"""
+import os
+import time
+import json
+import sqlite3
+import threading
+from multiprocessing.managers import BaseManager
+
+
+ADDED_COLUMNS = [("key", "TEXT"), ("followers", "TEXT"), ("attempts", "INTEGER DEFAULT 0")]
+
+
+class Scheduler(object):
+    """Pick the next job of a kind by per-user fair share and job cost
+
+    Users with less work running go first, then cheaper jobs. The cost of a
+    job is discounted the longer it waits, and any job waiting more than
+    max_wait seconds goes ahead of everything else, so big jobs still run.
+
+    Args:
+        workers: {kind: number of workers taking jobs of that kind}
+        throughput: {kind: cost units (voxels) processed per second per worker}
+        max_wait: seconds after which a job is scheduled before anything else
+        db_path: sqlite file the jobs are persisted in, None to keep them in memory
+        max_attempts: times a job is started before a restart drops it, so a
+                      job that brings the bot down is not run forever
+    """
+    def __init__(self, workers, throughput, max_wait=3600, db_path=None, max_attempts=3):
+        self.workers = dict(workers)
+        self.throughput = dict(throughput)
+        self.max_wait = max_wait
+        self.pending = []
+        self.running = {}
+        self.cond = threading.Condition()
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path or ':memory:', check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, kind TEXT, user TEXT, "
+                            "cost REAL, payload TEXT, submitted REAL, checkpoint TEXT)")
+            # columns added after the first version of the table
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+            for name, decl in ADDED_COLUMNS:
+                if name not in columns:
+                    self.db.execute("ALTER TABLE jobs ADD COLUMN {} {}".format(name, decl))
+        # every job still in the database was queued or running when the
+        # previous scheduler stopped, queue them again with their checkpoints
+        self.resumed = []
+        self.dropped = []
+        for row in self.db.execute("SELECT id, kind, user, cost, payload, submitted, checkpoint, key, followers, "
+                                   "attempts FROM jobs ORDER BY id").fetchall():
+            job = {
+                'id': row[0],
+                'kind': row[1],
+                'user': row[2],
+                'cost': row[3],
+                'payload': json.loads(row[4]),
+                'submitted': row[5],
+                'checkpoint': json.loads(row[6]) if row[6] else None,
+                'key': row[7],
+                'followers': json.loads(row[8]) if row[8] else [],
+                'attempts': row[9] or 0
+            }
+            if job['attempts'] >= max_attempts:
+                self.dropped.append(job)
+                with self.db:
+                    self.db.execute("DELETE FROM jobs WHERE id = ?", (job['id'],))
+                continue
+            self.pending.append(job)
+            self.resumed.append(job['id'])
+
+    def submit(self, kind, user, cost, payload, key=None, follower=None):
+        """Queue a job, returns (job id, True if it was coalesced into an existing job)
+
+        A job queued with cost None is not scheduled until update_cost sets
+        its cost, so it never runs (or is ordered) on a placeholder cost.
+        If a job with the same key is queued, or running but has not loaded
+        its data yet (no checkpoint), nothing is queued and follower (e.g.
+        the slack message of the duplicate request) is added to the followers
+        of that job instead. A job that already loaded its data may miss
+        changes made since, so the request is queued again.
+        """
+        with self.cond:
+            if key is not None:
+                candidates = self.pending + [j for j in self.running.values() if j['checkpoint'] is None]
+                job = next((j for j in candidates if j['key'] == key), None)
+                if job is not None:
+                    if follower is not None:
+                        job['followers'].append(follower)
+                        with self.db:
+                            self.db.execute("UPDATE jobs SET followers = ? WHERE id = ?",
+                                            (json.dumps(job['followers']), job['id']))
+                    return job['id'], True
+            job = {
+                'kind': kind,
+                'user': user,
+                'cost': cost,
+                'payload': payload,
+                'submitted': time.time(),
+                'checkpoint': None,
+                'key': key,
+                'followers': [],
+                'attempts': 0
+            }
+            with self.db:
+                cur = self.db.execute("INSERT INTO jobs (kind, user, cost, payload, submitted, key) VALUES (?, ?, ?, ?, ?, ?)",
+                                      (kind, user, cost, json.dumps(payload), job['submitted'], key))
+            job['id'] = cur.lastrowid
+            self.pending.append(job)
+            self.cond.notify_all()
+            return job['id'], False
+
+    def checkpoint(self, job_id, state):
+        """Record the last completed stage of a running job"""
+        with self.cond:
+            job = self.running.get(job_id)
+            if job is not None:
+                job['checkpoint'] = state
+            with self.db:
+                self.db.execute("UPDATE jobs SET checkpoint = ? WHERE id = ?", (json.dumps(state), job_id))
+
+    def update_cost(self, job_id, cost):
+        """Set the cost of a job, which releases a job held without one"""
+        with self.cond:
+            job = self.running.get(job_id) or next((j for j in self.pending if j['id'] == job_id), None)
+            if job is not None:
+                job['cost'] = cost
+            with self.db:
+                self.db.execute("UPDATE jobs SET cost = ? WHERE id = ?", (cost, job_id))
+            self.cond.notify_all()
+
+    def resumed_jobs(self):
+        """Jobs reloaded from the database that are still queued"""
+        with self.cond:
+            return [j for j in self.pending if j['id'] in self.resumed]
+
+    def dropped_jobs(self):
+        """Jobs reloaded from the database that were started max_attempts times already"""
+        with self.cond:
+            return list(self.dropped)
+
+    def _ordered(self, kind, now):
+        running_cost = {}
+        for job in self.running.values():
+            if job['kind'] == kind:
+                running_cost[job['user']] = running_cost.get(job['user'], 0) + job['cost']
+
+        def priority(job):
+            wait = now - job['submitted']
+            if wait > self.max_wait:
+                return (0, 0, 0, job['submitted'])
+            return (1, running_cost.get(job['user'], 0), job['cost'] / (1.0 + wait / self.max_wait), job['submitted'])
+
+        return sorted((j for j in self.pending if j['kind'] == kind and j['cost'] is not None), key=priority)
+
+    def next_job(self, kind):
+        """Block until a job of kind is available, mark it running and return it"""
+        with self.cond:
+            while True:
+                jobs = self._ordered(kind, time.time())
+                if jobs:
+                    job = jobs[0]
+                    self.pending.remove(job)
+                    job['started'] = time.time()
+                    job['attempts'] += 1
+                    with self.db:
+                        self.db.execute("UPDATE jobs SET attempts = ? WHERE id = ?", (job['attempts'], job['id']))
+                    self.running[job['id']] = job
+                    return job
+                self.cond.wait()
+
+    def done(self, job_id):
+        """Remove a finished (or a dropped pending) job, returns the followers coalesced into it"""
+        with self.cond:
+            job = self.running.pop(job_id, None)
+            if job is None:
+                job = next((j for j in self.pending if j['id'] == job_id), None)
+                if job is not None:
+                    self.pending.remove(job)
+            with self.db:
+                self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.cond.notify_all()
+            return job['followers'] if job is not None else []
+
+    def status(self, job_id):
+        """(position, estimated seconds until start) of a pending job, None if it is not pending or held"""
+        with self.cond:
+            now = time.time()
+            job = next((j for j in self.pending if j['id'] == job_id), None)
+            if job is None or job['cost'] is None:
+                return None
+            kind = job['kind']
+            jobs = self._ordered(kind, now)
+            position = jobs.index(job)
+            running = [j for j in self.running.values() if j['kind'] == kind]
+            workers = max(1, self.workers.get(kind, 1))
+            throughput = self.throughput.get(kind, 1)
+            if position + len(running) < workers:
+                return position + 1, 0
+            remaining = sum(max(0, j['cost'] - (now - j['started']) * throughput) for j in running)
+            ahead = sum(j['cost'] for j in jobs[:position])
+            return position + 1, (remaining + ahead) / throughput / workers
+
+
+class SchedulerManager(BaseManager):
+    pass
+
+
+SchedulerManager.register('Scheduler', Scheduler)
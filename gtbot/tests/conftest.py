@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the bot imports its modules by name and reads its tokens from the environment
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for k in ["SLACK_BOT_TOKEN", "OAUTH_TOKEN", "WORKSPACE_PREFIX"]:
+    os.environ.setdefault(k, "test")
@@ -0,0 +1,27 @@
+import numpy as np
+
+import bbox
+
+
+def test_segment_points(monkeypatch):
+    monkeypatch.setattr(bbox, 'BLOCK', 1000)
+    rng = np.random.RandomState(0)
+    seg = np.repeat(rng.randint(0, 6, (10, 12, 5)), 3, axis=0).astype(np.uint64) * 1000003
+    seg = np.asfortranarray(seg)
+    seg[:4] = 0
+    segs, counts = np.unique(seg, return_counts=True)
+    expected = set(s for s, c in zip(segs, counts) if s != 0 and c >= 20)
+    for interior in (False, True):
+        points = bbox.segment_points(seg, 20, interior)
+        assert set(s for s, _ in points) == expected
+        assert all(seg[p] == s for s, p in points)
+        sizes = [counts[segs == s][0] for s, _ in points]
+        assert sizes == sorted(sizes, reverse=True)
+
+
+def test_segment_points_interior():
+    seg = np.zeros((20, 20, 20), dtype=np.uint32, order='F')
+    seg[2:18, 2:18, 2:18] = 7
+    (segid, point), = bbox.segment_points(seg, 1, True)
+    # any of the 8 central voxels is the deepest
+    assert segid == 7 and all(c in (9, 10) for c in point)
@@ -0,0 +1,56 @@
+import os
+
+from downloader import link_cutout
+
+
+def test_link_cutout(tmp_path):
+    src = tmp_path / "alice" / "cutout"
+    (src / "raw").mkdir(parents=True)
+    (src / "export").mkdir()
+    for fn in ["raw/001.png", "raw/002.png", "raw/notes.txt", "raw.h5", "metadata.json", "export/001.png",
+               ".gtbot_revisions.json"]:
+        (src / fn).write_text(fn)
+    dst = tmp_path / "bob" / "cutout"
+    link_cutout(str(src), str(dst), "png")
+    assert sorted(os.listdir(str(dst))) == ["raw", "raw.h5"]
+    assert sorted(os.listdir(str(dst / "raw"))) == ["001.png", "002.png"]
+    assert os.path.samefile(str(src / "raw/001.png"), str(dst / "raw/001.png"))
+    # raw.h5 may be opened for writing, so it is a copy of its own
+    assert not os.path.samefile(str(src / "raw.h5"), str(dst / "raw.h5"))
+    assert (dst / "raw.h5").read_text() == "raw.h5"
+
+
+def test_chained_cutouts_are_bounded(tmp_path, monkeypatch):
+    import numpy as np
+    from cloudvolume import CloudVolume
+    import downloader
+
+    info = CloudVolume.create_new_info(1, 'image', 'uint8', 'raw', [4, 4, 40], [0, 0, 0], [1024, 64, 4],
+                                       chunk_size=[64, 64, 4])
+    layer = "file://" + str(tmp_path / "layer")
+    cv = CloudVolume(layer, info=info)
+    cv.commit_info()
+    cv[:, :, :] = np.ones((1024, 64, 4), dtype=np.uint8)
+    monkeypatch.setattr(downloader, "reply", lambda *args, **kwargs: None)
+    monkeypatch.setattr(downloader, "user_info", lambda handle, key: "tester")
+    calls = []
+
+    def recording_map_bounded(fn, items, sizes, parallel, budget):
+        calls.append((sizes, budget))
+        return map_bounded(fn, items, sizes, parallel, budget)
+    map_bounded = downloader.map_bounded
+    monkeypatch.setattr(downloader, "map_bounded", recording_map_bounded)
+
+    # 20 padded cutouts, each overlapping the next one
+    annotations = [{'type': 'axis_aligned_bounding_box', 'pointA': [16 + 40*i, 16, 0],
+                    'pointB': [48 + 40*i, 48, 4]} for i in range(20)]
+    payload = {'layers': [{'type': 'image', 'source': "precomputed://" + layer},
+                          {'type': 'annotation', 'annotations': annotations}]}
+    parameters = {'mip': 0, 'pad': [16, 16, 0], 'prefix': str(tmp_path / "cutouts"), 'parallel': 2,
+                  'max_union_cutouts': 2, 'in_flight_cutouts': 2}
+    msgs = downloader.parse_nglink(None, "", parameters, payload)
+    assert len(msgs) == 20
+    sizes, budget = calls[0]
+    cutout = 64 * 64 * 4
+    assert max(sizes) <= 2 * cutout
+    assert budget == 2 * cutout
@@ -0,0 +1,184 @@
+import helper
+
+
+def reset_session(monkeypatch):
+    monkeypatch.setitem(helper._states, 'pid', None)
+    monkeypatch.setitem(helper._states, 'session', None)
+
+
+def test_state_session_retries(monkeypatch):
+    reset_session(monkeypatch)
+    session = helper.state_session()
+    retry = session.get_adapter(helper.NGLSTATE_POST).max_retries
+    assert retry.total == helper.STATE_RETRIES
+    assert retry.is_retry('POST', 503)
+    assert session is helper.state_session()
+
+
+def test_state_session_old_urllib3(monkeypatch):
+    # urllib3 < 1.26 only knows method_whitelist
+    class Retry(object):
+        created = []
+
+        def __init__(self, total=None, backoff_factor=0, status_forcelist=None, method_whitelist=None):
+            self.method_whitelist = method_whitelist
+            Retry.created.append(self)
+
+    monkeypatch.setattr(helper, 'Retry', Retry)
+    monkeypatch.setattr(helper, 'HTTPAdapter', lambda max_retries: helper.requests.adapters.HTTPAdapter())
+    reset_session(monkeypatch)
+    helper.state_session()
+    assert Retry.created[0].method_whitelist is False
+
+
+def test_fetch_state_only_caches_state_service(monkeypatch):
+    class Response(object):
+        def __init__(self, text):
+            self.text = text
+
+        def raise_for_status(self):
+            pass
+
+    class Session(object):
+        def __init__(self):
+            self.calls = 0
+
+        def get(self, url, timeout=None):
+            self.calls += 1
+            return Response('{"n": %d}' % self.calls)
+
+    session = Session()
+    monkeypatch.setattr(helper, 'state_session', lambda: session)
+    monkeypatch.setitem(helper._states, 'cache', helper.TTLCache(60, 8))
+    url = helper.NGLSTATE_HOST + "api/v1/1"
+    assert helper.fetch_state(url) == helper.fetch_state(url)
+    other = "https://example.com/state.json"
+    assert helper.fetch_state(other) != helper.fetch_state(other)
+
+
+def test_merge_bboxes():
+    from cloudvolume.lib import Bbox
+    boxes = [Bbox((0, 0, 0), (10, 10, 10)), Bbox((5, 0, 0), (15, 10, 10)), Bbox((100, 100, 0), (110, 110, 10))]
+    groups = helper.merge_bboxes(boxes)
+    assert [members for _, members in groups] == [[0, 1], [2]]
+    assert groups[0][0] == Bbox((0, 0, 0), (15, 10, 10))
+    assert len(helper.merge_bboxes(boxes, max_volume=1000)) == 3
+
+
+def test_map_bounded_budget():
+    import threading
+    import time
+    lock = threading.Lock()
+    state = {'now': 0, 'peak': 0}
+
+    def work(size):
+        with lock:
+            state['now'] += size
+            state['peak'] = max(state['peak'], state['now'])
+        time.sleep(0.01)
+        with lock:
+            state['now'] -= size
+        return size * 2
+
+    sizes = [3, 3, 3, 5, 1, 1]
+    assert helper.map_bounded(work, sizes, sizes, 4, 6) == [s * 2 for s in sizes]
+    assert state['peak'] <= 6
+
+
+def test_trim_cache(tmp_path):
+    import os
+    import time
+    now = time.time()
+    for i in range(6):
+        fn = str(tmp_path / str(i))
+        with open(fn, 'wb') as f:
+            f.write(b'x' * 100)
+        # 0 was written long ago but is read all the time
+        os.utime(fn, (now, now - 7200) if i == 0 else (now - 600 + i, now - 600 + i))
+    helper.trim_cache({'path': str(tmp_path), 'max_bytes': 300, 'max_age': 3600})
+    assert sorted(os.listdir(str(tmp_path))) == ['.lock', '.trim', '3', '4', '5']
+
+
+def test_trim_cache_waits_for_readers(tmp_path):
+    import fcntl
+    import os
+    import threading
+    with open(str(tmp_path / "chunk"), 'wb') as f:
+        f.write(b'x' * 100)
+    cache = {'path': str(tmp_path), 'max_bytes': 0}
+    reader = open(str(tmp_path / ".lock"), 'a')
+    fcntl.flock(reader, fcntl.LOCK_SH)
+    t = threading.Thread(target=helper.trim_cache, args=(cache,))
+    t.start()
+    t.join(0.5)
+    # a reader may have listed the chunk already
+    assert t.is_alive() and os.path.exists(str(tmp_path / "chunk"))
+    reader.close()
+    t.join()
+    assert not os.path.exists(str(tmp_path / "chunk"))
+    # a job checking its budget again right away skips the walk
+    with open(str(tmp_path / "chunk"), 'wb') as f:
+        f.write(b'x' * 100)
+    helper.trim_cache(cache, min_interval=60)
+    assert os.path.exists(str(tmp_path / "chunk"))
+
+
+class TrackedNumpy(object):
+    """numpy, counting the slabs still alive whenever a new one is allocated"""
+    def __init__(self, min_size):
+        import numpy
+        self.np = numpy
+        self.min_size = min_size
+        self.slabs = []
+        self.alive = []
+
+    def __getattr__(self, name):
+        return getattr(self.np, name)
+
+    def track(self, arr):
+        import weakref
+        if arr.size >= self.min_size:
+            self.alive.append(sum(r() is not None for r in self.slabs))
+            self.slabs.append(weakref.ref(arr))
+        return arr
+
+    def empty(self, *args, **kwargs):
+        return self.track(self.np.empty(*args, **kwargs))
+
+    def zeros(self, *args, **kwargs):
+        return self.track(self.np.zeros(*args, **kwargs))
+
+
+def test_dir_slabs_hold_one_slab(tmp_path, monkeypatch):
+    import numpy as np
+    from PIL import Image
+    for z in range(8):
+        Image.fromarray(np.full((30, 20), z, dtype=np.uint8)).save(str(tmp_path / "{:03d}.tif".format(z)))
+    tracked = TrackedNumpy(20 * 30 * 2)
+    monkeypatch.setattr(helper, 'np', tracked)
+    for zslice, data in helper.dir_slabs(str(tmp_path), n_workers=1, slab_depth=2):
+        assert data['uploaded_image'][0, 0, 0] == zslice.start
+        del data
+    assert tracked.alive == [0, 0, 0, 0]
+
+
+def test_omni_h5_slabs_hold_one_slab(tmp_path, monkeypatch):
+    import h5py
+    import numpy as np
+    fn = str(tmp_path / "seg.h5")
+    with h5py.File(fn, 'w') as f:
+        f.create_dataset('main', data=np.arange(8*30*20, dtype=np.uint32).reshape(8, 30, 20))
+    tracked = TrackedNumpy(20 * 30 * 2)
+    monkeypatch.setattr(helper, 'np', tracked)
+    for zslice, data in helper.omni_h5_slabs(fn, slab_depth=2):
+        del data
+    assert tracked.alive == [0, 0, 0, 0]
+
+
+def test_dataset_key():
+    key = helper.dataset_key("/mnt/seungmount/research/gt/cutout")
+    assert key == "research/gt/cutout"
+    assert helper.dataset_key("/mnt/seungmount/research/gt/cutout/") == key
+    assert helper.dataset_key("/home/u/seungmount/research//gt/cutout") == key
+    assert helper.dataset_key("Z:\\research\\gt\\cutout\\") == key
+    assert helper.dataset_key("elsewhere/cutout/") == "elsewhere/cutout"
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from cloudvolume import CloudVolume
+from cloudvolume.lib import Bbox
+
+import uploader
+from revision import chunk_hashes, chunk_slices, load_revision
+from uploader import upload_dataset, write_changed_chunks
+
+
+def test_chunk_hashes_and_slices():
+    data = np.arange(128*64*16, dtype=np.uint8).reshape((128, 64, 16))
+    hashes = chunk_hashes(data[:, :, 8:], (64, 64, 8), z_offset=8)
+    assert sorted(hashes) == ["0_0_1", "1_0_1"]
+    local = chunk_slices("1_0_1", (64, 64, 8), z_offset=8)
+    assert local == (slice(64, 128), slice(0, 64), slice(0, 8))
+    full = chunk_hashes(data, (64, 64, 8))
+    assert all(full[k] == hashes[k] for k in hashes)
+
+
+def test_write_changed_chunks(tmp_path):
+    info = CloudVolume.create_new_info(1, 'segmentation', 'uint32', 'raw', [4, 4, 40], [0, 0, 0], [128, 64, 8],
+                                       chunk_size=[64, 64, 8])
+    cv = CloudVolume("file://" + str(tmp_path), info=info, bounded=False, fill_missing=True)
+    cv.commit_info()
+    data = np.ones((128, 64, 8), dtype=np.uint32)
+    cv[0:128, 0:64, 0:8] = data
+    hashes = chunk_hashes(data, (64, 64, 8))
+    data[70, 10, 3] = 5
+    changed, segids = write_changed_chunks(cv, Bbox((0, 0, 0), (128, 64, 8)), slice(0, 8), data, (64, 64, 8),
+                                           hashes, True)
+    assert [b.to_list() for b in changed] == [[64, 0, 0, 128, 64, 8]]
+    assert segids == {1, 5}
+    assert hashes == chunk_hashes(data, (64, 64, 8))
+    assert cv[70, 10, 3][0, 0, 0, 0] == 5
+
+
+class Interrupted(Exception):
+    pass
+
+
+def write_stack(path, img):
+    os.makedirs(path, exist_ok=True)
+    for z in range(img.shape[2]):
+        Image.fromarray(np.ascontiguousarray(img[:, :, z].T)).save(os.path.join(path, "{:03d}.png".format(z)))
+
+
+@pytest.fixture
+def layers(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploader, "LAYER_PATH", "file://" + str(tmp_path / "{bucket}/{author}/{name}"))
+    monkeypatch.setattr(uploader, "reply", lambda *args, **kwargs: None)
+    monkeypatch.setattr(uploader, "user_info", lambda handle, key: "tester")
+
+    def no_state(payload):
+        raise IOError("no state service")
+    monkeypatch.setattr(uploader, "post_state", no_state)
+
+
+def test_revision_update(tmp_path, layers):
+    # mip 1 layer whose voxel offset (500) is not on the downsampling task grid
+    metadata = {'raw': {'pad': [0, 0, 0], 'src_path': "file://unused", 'mip': 1, 'voxel_size': [4, 4, 40],
+                        'bbox': [1000, 0, 0, 2280, 256, 16]}}
+    path = str(tmp_path / "cutout" / "export")
+    img = np.zeros((640, 128, 16), dtype=np.uint8)
+    write_stack(path, img)
+    parameters = {'revision': True, 'parallel': 1, 'stream_depth': 8}
+    assert upload_dataset("", path, "bucket", metadata, parameters)
+    first = load_revision(path, "bucket")
+    layer = first['layers']['uploaded_image']['path']
+
+    # one edited chunk starting at x=564, interrupted once it is written
+    img[64:128, 0:64, 8:16] = 200
+    write_stack(path, img)
+    states = []
+
+    def checkpoint(state):
+        states.append(state)
+        if state['stage'] == 'uploaded':
+            raise Interrupted()
+    with pytest.raises(Interrupted):
+        upload_dataset("", path, "bucket", metadata, parameters, checkpoint=checkpoint)
+    resume = [s for s in states if s['stage'] == 'loaded'][-1]
+    assert resume['changed']['uploaded_image']['bboxes'] == [[564, 0, 8, 628, 64, 16]]
+
+    # the rewritten chunk no longer differs, its change comes from the checkpoint
+    states = []
+    assert upload_dataset("", path, "bucket", metadata, parameters, checkpoint=states.append, resume=resume)
+    uploaded = [s for s in states if s['stage'] == 'uploaded'][-1]
+    task = uploaded['process']['uploaded_image']
+    assert task['downsample'] and task['num_mips'] > 0
+    assert load_revision(path, "bucket")['revision'] == first['revision'] + 1
+
+    cv = CloudVolume(layer, mip=2)
+    assert cv.voxel_offset[0] == 250
+    assert np.all(cv[282:314, 0:32, 8:16] == 200)
+    assert np.all(cv[250:282, 0:32, 8:16] == 0)
@@ -0,0 +1,95 @@
+import sqlite3
+
+from scheduler import Scheduler
+
+
+def make(db_path=None):
+    return Scheduler({'upload': 1}, {'upload': 1}, db_path=db_path)
+
+
+def test_coalesce_pending_and_unloaded_running():
+    s = make()
+    job_id, coalesced = s.submit('upload', 'a', 10, {}, 'k', {'n': 1})
+    assert not coalesced
+    assert s.submit('upload', 'b', 10, {}, 'k', {'n': 2}) == (job_id, True)
+    job = s.next_job('upload')
+    assert s.submit('upload', 'b', 10, {}, 'k', {'n': 3}) == (job_id, True)
+    s.checkpoint(job['id'], {'stage': 'loaded'})
+    new_id, coalesced = s.submit('upload', 'b', 10, {}, 'k', {'n': 4})
+    assert not coalesced and new_id != job_id
+    assert s.done(job_id) == [{'n': 2}, {'n': 3}]
+
+
+def test_old_database_is_migrated(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    db = sqlite3.connect(db_path)
+    with db:
+        db.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY, kind TEXT, user TEXT, "
+                   "cost REAL, payload TEXT, submitted REAL, checkpoint TEXT)")
+        db.execute("INSERT INTO jobs (kind, user, cost, payload, submitted) VALUES ('upload', 'a', 1, '{}', 0)")
+    db.close()
+    s = make(db_path)
+    assert [j['followers'] for j in s.resumed_jobs()] == [[]]
+    s.submit('upload', 'a', 1, {}, 'k')
+
+
+def test_jobs_survive_restart(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    s = make(db_path)
+    s.submit('upload', 'a', 1, {'x': 1})
+    job = s.next_job('upload')
+    s.checkpoint(job['id'], {'stage': 'uploaded'})
+    resumed = make(db_path).resumed_jobs()
+    assert [(j['payload'], j['checkpoint']) for j in resumed] == [({'x': 1}, {'stage': 'uploaded'})]
+
+
+def test_job_dropped_after_max_attempts(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    for _ in range(3):
+        s = Scheduler({'upload': 1}, {'upload': 1}, db_path=db_path, max_attempts=3)
+        assert len(s.resumed_jobs()) == (0 if _ == 0 else 1)
+        if _ == 0:
+            s.submit('upload', 'a', 1, {})
+        s.next_job('upload')
+    s = Scheduler({'upload': 1}, {'upload': 1}, db_path=db_path, max_attempts=3)
+    assert s.resumed_jobs() == []
+    assert [j['attempts'] for j in s.dropped_jobs()] == [3]
+
+
+def test_update_cost():
+    s = make()
+    job_id, _ = s.submit('upload', 'a', 10, {})
+    s.update_cost(job_id, 1000)
+    assert s.next_job('upload')['cost'] == 1000
+
+
+def test_ordered_by_cost_share_and_wait():
+    s = Scheduler({'upload': 2}, {'upload': 1}, max_wait=100)
+    big, _ = s.submit('upload', 'a', 1000, {})
+    small, _ = s.submit('upload', 'b', 10, {})
+    medium, _ = s.submit('upload', 'c', 100, {})
+    for job in s.pending:
+        job['submitted'] = 0
+    # cheaper jobs first
+    assert [j['id'] for j in s._ordered('upload', 0)] == [small, medium, big]
+    # users with work running go after the others, whatever the cost
+    s.running[99] = {'kind': 'upload', 'user': 'b', 'cost': 50}
+    assert [j['id'] for j in s._ordered('upload', 0)] == [medium, big, small]
+    # a job waiting longer than max_wait goes ahead of everything
+    s.pending[0]['submitted'] = -50
+    s.pending[1]['submitted'] = 0
+    s.pending[2]['submitted'] = 0
+    assert [j['id'] for j in s._ordered('upload', 60)][0] == big
+
+
+def test_job_held_until_its_cost_is_known():
+    s = make()
+    held, _ = s.submit('upload', 'a', None, {})
+    assert s._ordered('upload', 0) == []
+    assert s.status(held) is None
+    s.update_cost(held, 5)
+    assert s.next_job('upload')['id'] == held
+    dropped, _ = s.submit('upload', 'a', None, {}, 'k', {'n': 1})
+    s.submit('upload', 'b', None, {}, 'k', {'n': 2})
+    assert s.done(dropped) == [{'n': 2}]
+    assert s.pending == []
@@ -0,0 +1,10 @@
+from uploader import check_upload_options
+
+
+def test_check_upload_options():
+    assert check_upload_options({}) is None
+    assert check_upload_options({'seg_encoding': 'compressed_segmentation', 'image_encoding': 'jpeg',
+                                 'revision': True}) is None
+    assert "Unknown" in check_upload_options({'parallel': 64})
+    assert "Invalid" in check_upload_options({'seg_encoding': 'png'})
+    assert "Invalid" in check_upload_options({'revision': 1})
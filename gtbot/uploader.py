@@ -1,19 +1,38 @@
-from helper import load_from_dir, reply, user_info, safe_string, load_from_omni_h5
+from helper import dir_slabs, reply, post_state, user_info, safe_string, load_from_omni_h5, omni_h5_slabs, OMNI_TYPES
+from revision import load_revision, save_revision, chunk_hashes, chunk_slices
 
-from cloudvolume import CloudVolume
+from cloudvolume import CloudVolume, Storage
 from cloudvolume.lib import Bbox, Vec
 from taskqueue import LocalTaskQueue
 import igneous.task_creation as tc
 from time import sleep
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
 
 from datetime import datetime
 import numpy as np
+import os
 import secrets
 import urllib
-import requests
 import json
 from collections import OrderedDict
-from bot_info import oauth_token
+
+CHUNK_SIZE = (64, 64, 8)
+MAX_CHUNK_SIZE = (512, 512, 32)
+IMAGE_ENCODINGS = ('raw', 'jpeg')
+SEG_ENCODINGS = ('raw', 'compressed_segmentation')
+JPEG_VOXELS = 512*1024*1024
+MESH_TASK_VOXELS = 512*512*128
+PARALLEL = os.cpu_count() or 16
+LAYER_PATH = "gs://{bucket}/{author}/{name}"
+# upload parameters users may set in the metadata or the command, with their allowed values
+USER_OPTIONS = {
+    'image_encoding': IMAGE_ENCODINGS,
+    'seg_encoding': SEG_ENCODINGS,
+    'revision': (True, False)
+}
 
 def create_nglink(image_layer, seg_layers, center):
     ng_host = "https://neuromancer-seung-import.appspot.com"
@@ -24,7 +43,7 @@ def create_nglink(image_layer, seg_layers, center):
     }
 
     for s in seg_layers:
-        if "img" in s or "image" in s:
+        if is_image_layer(s):
             layers[s] = {
                 "source": "precomputed://"+seg_layers[s],
                 "type": "image",
@@ -54,30 +73,27 @@ def create_nglink(image_layer, seg_layers, center):
     )
 
     try:
-        headers = {'Authorization': 'Bearer {}'.format(oauth_token)}
-        r = requests.post('https://globalv1.daf-apis.com/nglstate/post', headers=headers, data=json.dumps(payload))
-    except:
+        ng_link = post_state(payload)
+    except Exception:
         return "neuroglancer link: {}".format(url)
 
-    if r.ok:
-        link = r.text.strip()
-        link = link[1:-1]
-        ng_link = "https://neuromancer-seung-import.appspot.com/?json_url={}".format(link)
-        return "neuroglancer link: {}".format(ng_link)
-    else:
-        return "neuroglancer link: {}".format(url)
+    return "neuroglancer link: {}".format(ng_link)
 
 
-def upload_dataset(handle, path, bucket, metadata):
-    try:
-        parameters = metadata['raw']
-        pad = Vec(*parameters['pad'])
-        image_layer = parameters['src_path']
-        mip = parameters['mip']
-    except KeyError:
-        reply(handle, "I do not understand the metadata", broadcast=True)
-        return False
+def crop_bbox_in_data(vol_start, vol_stop, pad, mip):
+    """Bbox of the unpadded volume inside the padded cutout, at mip
 
+    Matches CloudVolume.bbox_to_mip for scales of [2^mip, 2^mip, 1]
+    """
+    factor = Vec(1<<mip, 1<<mip, 1)
+    src_minpt = (vol_start - pad) // factor
+    dst_minpt = vol_start // factor
+    dst_maxpt = -((-vol_stop) // factor)
+    return Bbox(dst_minpt - src_minpt, dst_maxpt - src_minpt)
+
+
+def dataset_bbox(parameters):
+    """(vol_start, vol_stop) at mip 0 from the metadata, None if it cannot be constructed"""
     try:
         size = Vec(*parameters['size'])
         center = Vec(*parameters['center'])
@@ -85,133 +101,338 @@ def upload_dataset(handle, path, bucket, metadata):
         vol_stop = center + size//2 - Vec(1,1,0)
     except KeyError:
         if 'bbox' not in parameters:
-            reply(handle, "Cannot contruct the bounding box", broadcast=True)
-            return False
+            return None
         bbox = parameters['bbox']
         vol_start = Vec(*bbox[0:3])
         vol_stop = Vec(*bbox[3:6])
+    return vol_start, vol_stop
+
 
-    data = None
+def estimate_upload(path, metadata):
+    """Voxels an upload of the dataset at path writes at its base mip, over all its layers"""
+    try:
+        parameters = metadata['raw']
+        mip = parameters['mip']
+    except KeyError:
+        return 0
+    bbox = dataset_bbox(parameters)
+    if bbox is None:
+        return 0
+    size = crop_bbox_in_data(bbox[0], bbox[1], Vec(0,0,0), mip).size3()
+    layers = 1
+    if path.endswith('.h5') and os.path.exists(os.path.join(os.path.split(path)[0], "segments.txt")):
+        layers += len(OMNI_TYPES)
+    return int(np.prod(size)) * layers
+
+
+def open_slabs(path, crop, slab_depth, upload_parameters):
+    """Slab generator for the dataset at path, None if nothing can be loaded"""
     if path.endswith('.h5'):
-        data = load_from_omni_h5(path)
+        candidates = [omni_h5_slabs(path, slab_depth, crop=crop)]
     else:
         extensions = ['tif', 'png']
-        for e in extensions:
-            data = load_from_dir(path, extension=e)
-            if data:
-                break
-
-    ng_layers = {}
-    for k in data:
-        reply(handle, "Uploading layer {}".format(k))
-        if "img" in k or "image" in k:
-            img_layer = upload_img(handle, bucket, data[k], vol_start, vol_stop, metadata)
-            ng_layers[k] = img_layer
-        else:
-            seg_layer = upload_seg(handle, bucket, data[k], vol_start, vol_stop, metadata)
-            ng_layers[k] = seg_layer
+        candidates = (dir_slabs(path, extension=e, crop=crop, slab_depth=slab_depth,
+                                n_workers=upload_parameters.get('decode_workers', -1)) for e in extensions)
+    for slabs in candidates:
+        first = next(slabs, None)
+        if first is not None:
+            return chain([first], slabs)
+    return None
+
+
+def upload_dataset(handle, path, bucket, metadata, upload_parameters=None, checkpoint=None, resume=None):
+    """Upload the dataset at path as new (or, in revision mode, updated) layers
+
+    checkpoint(state) is called at every completed stage with a json
+    serializable state, resume takes the last such state of an interrupted
+    upload and continues from it. An interrupted revision update is written
+    again from the start, with the changes recorded before the interruption
+    carried over from its checkpoint. Returns the neuroglancer link of the
+    uploaded layers, False if the upload failed.
+    """
+    if upload_parameters is None:
+        upload_parameters = {}
+    if resume is not None and resume.get('stage') == 'uploaded':
+        reply(handle, "resuming the upload from the {} stage".format(resume['stage']))
+        return finish_upload(handle, path, bucket, resume, checkpoint)
+
+    try:
+        parameters = metadata['raw']
+        pad = Vec(*parameters['pad'])
+        image_layer = parameters['src_path']
+        mip = parameters['mip']
+    except KeyError:
+        reply(handle, "I do not understand the metadata", broadcast=True)
+        return False
+
+    bbox = dataset_bbox(parameters)
+    if bbox is None:
+        reply(handle, "Cannot contruct the bounding box", broadcast=True)
+        return False
+    vol_start, vol_stop = bbox
+
+    dst_bbox = Bbox(vol_start, vol_stop)
+    revision = None
+    if upload_parameters.get('revision'):
+        revision = load_revision(path, bucket)
+        if revision is not None and (revision['bbox'] != [int(x) for x in dst_bbox.to_list()] or revision['mip'] != mip):
+            reply(handle, "The bounding box changed, starting a new revision history")
+            revision = None
+
+    reply(handle, "loading the dataset...")
+    crop_bbox = crop_bbox_in_data(vol_start, vol_stop, pad, mip)
+    crop = crop_bbox.to_slices()
+    if revision is not None:
+        chunk_size = tuple(revision['chunk_size'])
+    else:
+        chunk_size = upload_parameters.get('chunk_size') or choose_chunk_size(crop_bbox.size3())
+    stream_depth = upload_parameters.get('stream_depth')
+    if stream_depth:
+        # whole chunks along z, so every slab write is chunk aligned
+        chunk_z = chunk_size[2]
+        slabs = open_slabs(path, crop, -(-stream_depth // chunk_z) * chunk_z, upload_parameters)
+    elif path.endswith('.h5'):
+        data = load_from_omni_h5(path, crop=crop)
+        slabs = iter([(slice(0, None), data)]) if data else None
+    else:
+        slabs = open_slabs(path, crop, None, upload_parameters)
+
+    first = next(slabs, None) if slabs is not None else None
+    if first is None:
+        reply(handle, "Cannot load the dataset", broadcast=True)
+        return False
+
+    if revision is not None and sorted(revision['layers']) != sorted(first[1]):
+        reply(handle, "The layers changed, starting a new revision history")
+        revision = None
+
+    author = layer_author(handle)
+    ng_layers = OrderedDict()
+    local_mips = count_local_mips(crop_bbox.size3(), upload_parameters.get('local_mips', 0), chunk_size)
+    layer_types = {k: 'image' if is_image_layer(k) else 'segmentation' for k in first[1]}
+    try:
+        encodings = {k: choose_encoding(layer_types[k], first[1][k].dtype, crop_bbox.size3(), upload_parameters)
+                     for k in first[1]}
+    except ValueError as e:
+        reply(handle, str(e), broadcast=True)
+        return False
+
+    if revision is None:
+        for k in first[1]:
+            reply(handle, "Creating {} layer {}".format(encodings[k], k))
+            ng_layers[k] = create_layer(bucket, author, layer_types[k], first[1][k].dtype, dst_bbox, metadata,
+                                        chunk_size, local_mips, encodings[k])
+    else:
+        # changed chunks are written into the previous layers, the upper
+        # mips are then refreshed by bounded downsampling tasks
+        local_mips = 0
+        for k in first[1]:
+            ng_layers[k] = revision['layers'][k]['path']
+        reply(handle, "Updating the layers of revision {}".format(revision['revision']))
+
+    hashes = None
+    if upload_parameters.get('revision'):
+        hashes = {k: dict(revision['layers'][k]['hashes']) if revision else {} for k in ng_layers}
+    changed_bboxes = {k: [] for k in ng_layers}
+    changed_segids = {k: set() for k in ng_layers}
+    if revision is not None and resume is not None and resume.get('revision') == revision['revision'] and \
+            sorted(resume.get('changed', {})) == sorted(ng_layers):
+        # chunks rewritten before the interruption no longer differ from the
+        # layer, their changes only survive in the checkpoint
+        reply(handle, "resuming the update of revision {}".format(revision['revision']))
+        for k in ng_layers:
+            changed_bboxes[k] = [Bbox.from_list(b) for b in resume['changed'][k]['bboxes']]
+            changed_segids[k] = set(resume['changed'][k]['segids'])
+
+    def save_progress():
+        if checkpoint is None:
+            return
+        state = {'stage': 'loaded'}
+        if revision is not None:
+            state['revision'] = revision['revision']
+            state['changed'] = {k: {'bboxes': [[int(x) for x in b.to_list()] for b in changed_bboxes[k]],
+                                    'segids': sorted(int(x) for x in changed_segids[k])} for k in ng_layers}
+        checkpoint(state)
+
+    save_progress()
+
+    # layers share one process budget and are processed side by side
+    parallel = max(1, upload_parameters.get('parallel', PARALLEL) // len(ng_layers))
+    # one handle per mip level written from memory, the base level first
+    cvs = {k: [open_layer(ng_layers[k], mip+i, parallel) for i in range(local_mips+1)] for k in ng_layers}
+    mip_bboxes = [cvs[k][0].bbox_to_mip(dst_bbox, 0, mip+i) for i in range(local_mips+1)]
+
+    with ThreadPoolExecutor(max_workers=len(ng_layers)) as executor:
+        reply(handle, "uploading...")
+        slabs = chain([first], slabs)
+        first = data = None
+        for zslice, data in slabs:
+            if revision is None:
+                futures = {k: executor.submit(write_levels, cvs[k], mip_bboxes, zslice, data[k], not is_image_layer(k))
+                           for k in data}
+                if hashes is not None:
+                    for k in data:
+                        hashes[k].update(chunk_hashes(data[k], chunk_size, zslice.start))
+            else:
+                futures = {k: executor.submit(write_changed_chunks, cvs[k][0], mip_bboxes[0], zslice, data[k],
+                                              chunk_size, hashes[k], not is_image_layer(k))
+                           for k in data}
+            for k in futures:
+                changes = futures[k].result()
+                if changes is not None:
+                    known = set(tuple(b.to_list()) for b in changed_bboxes[k])
+                    changed_bboxes[k] += [b for b in changes[0] if tuple(b.to_list()) not in known]
+                    changed_segids[k] |= changes[1]
+            if revision is not None:
+                save_progress()
+            # free the slab before the next one is loaded, the slab
+            # generators drop their references once it is yielded
+            del data
+
+    mesh_shape = choose_mesh_shape(crop_bbox.size3(), chunk_size, 2*parallel)
+    mesh_lod = upload_parameters.get('mesh_lod', 0)
+    process = OrderedDict()
+    if revision is None:
+        for k in ng_layers:
+            process[k] = {'downsample': local_mips == 0, 'bounds': None, 'object_ids': None}
+    else:
+        changed = [k for k in ng_layers if changed_bboxes[k]]
+        reply(handle, "{} changed chunk(s) and {} changed segment(s) in {} layer(s)".format(
+            sum(len(changed_bboxes[k]) for k in changed), sum(len(changed_segids[k]) for k in changed), len(changed)))
+        for k in changed:
+            bounds, num_mips = downsample_bounds(cvs[k][0], Bbox.expand(*changed_bboxes[k]), mip)
+            process[k] = {
+                'downsample': num_mips > 0,
+                'bounds': [int(x) for x in bounds.to_list()],
+                'num_mips': num_mips,
+                # sharded multi-resolution meshes cannot be patched per segment
+                'object_ids': sorted(int(x) for x in changed_segids[k]) if mesh_lod == 0 else None
+            }
+
+    save = None
+    if hashes is not None:
+        number = revision['revision'] + 1 if revision else 1
+        save = {
+            'revision': number,
+            'bbox': [int(x) for x in dst_bbox.to_list()],
+            'mip': mip,
+            'chunk_size': [int(x) for x in chunk_size],
+            'layers': {k: {'path': ng_layers[k], 'hashes': hashes[k]} for k in ng_layers},
+            'publish': {k: len(changed_bboxes[k]) for k in process} if revision is not None else {}
+        }
+
+    # everything needed to finish the upload, kept as a checkpoint so an
+    # interrupted upload resumes from here instead of starting over
+    state = {
+        'stage': 'uploaded',
+        'layers': ng_layers,
+        'progress': {k: 'uploaded' for k in process},
+        'process': process,
+        'author': author,
+        'mip': mip,
+        'parallel': parallel,
+        'mesh_shape': [int(x) for x in mesh_shape],
+        'mesh_lod': mesh_lod,
+        'revision': save,
+        'image_layer': image_layer,
+        'center': [float(vol_start[i] + vol_stop[i])/2 for i in range(3)]
+    }
+    if checkpoint is not None:
+        checkpoint(state)
+    return finish_upload(handle, path, bucket, state, checkpoint)
+
+
+def finish_upload(handle, path, bucket, state, checkpoint=None):
+    """Downsample and mesh the uploaded layers, then publish and link them
+
+    state is the checkpoint written by upload_dataset once the base mip is
+    uploaded. Layers that state['progress'] marks as done are skipped, so an
+    interrupted upload can be resumed from its last checkpoint.
+    """
+    ng_layers = state['layers']
+    progress = state['progress']
+    lock = Lock()
+
+    def advance(k, stage):
+        with lock:
+            progress[k] = stage
+            if checkpoint is not None:
+                checkpoint(state)
+
+    todo = [k for k in state['process'] if progress[k] != 'meshed' and
+            not (is_image_layer(k) and progress[k] == 'downsampled')]
+    if todo:
+        reply(handle, "downsampling and meshing {} layer(s)...".format(len(todo)))
+    with ThreadPoolExecutor(max_workers=max(1, len(todo))) as executor:
+        futures = []
+        for k in todo:
+            task = state['process'][k]
+            futures.append(executor.submit(process_layer, k, ng_layers[k], state['mip'], state['parallel'],
+                                           task['downsample'] and progress[k] == 'uploaded',
+                                           Vec(*state['mesh_shape']), state['mesh_lod'],
+                                           task['bounds'], task['object_ids'], partial(advance, k),
+                                           task.get('num_mips')))
+        for f in futures:
+            f.result()
+
+    save = state['revision']
+    if save is not None:
+        for k in save['publish']:
+            publish_revision(ng_layers[k], state['author'], save['revision'], save['publish'][k])
+        save_revision(path, bucket, dict((k, save[k]) for k in save if k != 'publish'))
+        reply(handle, "saved as revision {}".format(save['revision']))
 
     reply(handle, "done!", broadcast=True)
+    link = create_nglink(state['image_layer'], ng_layers, state['center'])
+    reply(handle, link)
+    return link
 
-    center = [(vol_start[i] + vol_stop[i])/2 for i in range(3)]
-    reply(handle, create_nglink(image_layer, ng_layers, center))
 
-#FIXME: reuse the code from upload_seg
-def upload_img(handle, bucket, data, vol_start, vol_stop, metadata):
-    parameters = metadata['raw']
-    pad = Vec(*parameters['pad'])
-    image_layer = parameters['src_path']
-    mip = parameters['mip']
+def is_image_layer(name):
+    return "img" in name or "image" in name
 
+
+def layer_author(handle):
     author = safe_string(user_info(handle, "display_name"))
-    p = 16
 
     if author is None or author.strip() == "":
         author = "gtbot"
 
-    img_layer = "gs://{}/{}/{}".format(bucket, author.replace(" ", "_"), secrets.token_hex(8))
-    dst_bbox = Bbox(vol_start, vol_stop)
-    mip0_bbox = Bbox(dst_bbox.minpt - pad, dst_bbox.maxpt + pad)
-    data_type = 'uint8' if data.dtype == np.uint8 else 'float32'
-    info = CloudVolume.create_new_info(
-        num_channels = 1,
-        layer_type   = 'image',
-        data_type    = data_type,
-        encoding     = 'raw',
-        resolution   = parameters['voxel_size'],
-        voxel_offset = dst_bbox.minpt,
-        volume_size  = dst_bbox.size3(),
-        chunk_size   = (64,64,8)
-    )
-
-    cv = CloudVolume(img_layer, mip=0, info=info)
-    for i in range(mip):
-        cv.add_scale([1<<(i+1),1<<(i+1),1])
-    cv.commit_info()
-    cv.provenance.processing.append({
-        'owner': author,
-        'timestamp': str(datetime.today()),
-        'image_path': image_layer
-    })
-    cv.commit_provenance()
+    return author
 
-    cv = CloudVolume(img_layer, mip=mip, parallel=p, bounded=False, autocrop=True,
-                     cdn_cache=False, fill_missing=True)
-
-    print("original bbox")
-    print(mip0_bbox)
-    print(dst_bbox)
-    src_bbox = cv.bbox_to_mip(mip0_bbox, 0, mip)
-    dst_bbox = cv.bbox_to_mip(dst_bbox, 0, mip)
-    crop_bbox = dst_bbox - src_bbox.minpt
-    reply(handle, "loading the image...".format(img_layer))
-    print(src_bbox)
-    print(dst_bbox)
-    print(data.shape)
-    data = data[crop_bbox.to_slices()]
-    print(crop_bbox)
-    print(data.shape)
-    print(dst_bbox)
-    reply(handle, "uploading...".format(img_layer))
-    cv[dst_bbox.to_slices()] = data
-    reply(handle, "downsampling...")
-    with LocalTaskQueue(parallel=p) as tq:
-        tasks = tc.create_downsampling_tasks(img_layer, mip=mip, fill_missing=True, preserve_chunk_size=True)
-        tq.insert_all(tasks)
-        print("downsampled")
-    return img_layer
 
+def create_layer(bucket, author, layer_type, dtype, dst_bbox, metadata, chunk_size=CHUNK_SIZE, extra_mips=0,
+                 encoding='raw'):
+    """Create a new image or segmentation layer covering dst_bbox, return its path
 
-def upload_seg(handle, bucket, data, vol_start, vol_stop, metadata):
+    extra_mips scales are added above the upload mip for levels written from memory
+    """
     parameters = metadata['raw']
-    pad = Vec(*parameters['pad'])
     image_layer = parameters['src_path']
     mip = parameters['mip']
 
-    p = 16
-    author = safe_string(user_info(handle, "display_name"))
-
-    if author is None or author.strip() == "":
-        author = "gtbot"
-
-    seg_layer = "gs://{}/{}/{}".format(bucket, author.replace(" ", "_"), secrets.token_hex(8))
-    dst_bbox = Bbox(vol_start, vol_stop)
-    mip0_bbox = Bbox(dst_bbox.minpt - pad, dst_bbox.maxpt + pad)
+    layer = LAYER_PATH.format(bucket=bucket, author=author.replace(" ", "_"), name=secrets.token_hex(8))
+    if layer_type == 'image':
+        data_type = 'uint8' if dtype == np.uint8 else 'float32'
+        mesh = None
+    else:
+        data_type = 'uint32'
+        mesh = 'mesh_mip_{}_err_0'.format(mip)
     info = CloudVolume.create_new_info(
         num_channels = 1,
-        layer_type   = 'segmentation',
-        data_type    = 'uint32',
-        encoding     = 'raw',
+        layer_type   = layer_type,
+        data_type    = data_type,
+        encoding     = encoding,
         resolution   = parameters['voxel_size'],
         voxel_offset = dst_bbox.minpt,
         volume_size  = dst_bbox.size3(),
-        mesh         = 'mesh_mip_{}_err_0'.format(mip),
-        chunk_size   = (64,64,8)
+        mesh         = mesh,
+        chunk_size   = chunk_size
     )
 
-    cv = CloudVolume(seg_layer, mip=0, info=info)
-    for i in range(mip):
-        cv.add_scale([1<<(i+1),1<<(i+1),1])
+    cv = CloudVolume(layer, mip=0, info=info)
+    for i in range(mip + extra_mips):
+        cv.add_scale([1<<(i+1),1<<(i+1),1], chunk_size=chunk_size)
     cv.commit_info()
     cv.provenance.processing.append({
         'owner': author,
@@ -219,40 +440,233 @@ def upload_seg(handle, bucket, data, vol_start, vol_stop, metadata):
         'image_path': image_layer
     })
     cv.commit_provenance()
+    return layer
+
+
+def open_layer(layer, mip, parallel=PARALLEL):
+    return CloudVolume(layer, mip=mip, parallel=parallel, bounded=False, autocrop=True,
+                       cdn_cache=False, fill_missing=True)
+
+
+def write_slab(cv, dst_bbox, zslice, data):
+    """Write data into the sections zslice (relative to dst_bbox) of the layer"""
+    minpt = dst_bbox.minpt + Vec(0, 0, zslice.start)
+    slab_bbox = Bbox(minpt, minpt + Vec(*data.shape[:3]))
+    print(slab_bbox, data.shape)
+    cv[slab_bbox.to_slices()] = data
+
+
+def choose_chunk_size(size):
+    """Chunk size for a layer whose upload mip has the given size
+
+    Powers of two, as large as possible (up to MAX_CHUNK_SIZE) while the
+    volume stays at least 4 chunks wide in x, y and 4 chunks deep in z, but
+    never smaller than CHUNK_SIZE. Bigger volumes get fewer, larger objects.
+    """
+    chunk = []
+    for s, lo, hi in zip(size, CHUNK_SIZE, MAX_CHUNK_SIZE):
+        c = lo
+        while c*2 <= hi and c*2*4 <= s:
+            c *= 2
+        chunk.append(c)
+    chunk[0] = chunk[1] = min(chunk[0], chunk[1])
+    return tuple(chunk)
+
+
+def choose_encoding(layer_type, dtype, size, upload_parameters):
+    """Chunk encoding of a new layer
+
+    upload_parameters['image_encoding'] / ['seg_encoding'] pick it explicitly.
+    By default segmentations use compressed_segmentation, uint8 images larger
+    than JPEG_VOXELS use jpeg and everything else stays raw (gzipped).
+    """
+    if layer_type == 'image':
+        encoding = upload_parameters.get('image_encoding')
+        if encoding is None:
+            encoding = 'jpeg' if dtype == np.uint8 and np.prod(size) > JPEG_VOXELS else 'raw'
+        if encoding == 'jpeg' and dtype != np.uint8:
+            encoding = 'raw'
+        supported = IMAGE_ENCODINGS
+    else:
+        encoding = upload_parameters.get('seg_encoding') or 'compressed_segmentation'
+        supported = SEG_ENCODINGS
+    if encoding not in supported:
+        raise ValueError("unsupported {} encoding {}, use one of {}".format(layer_type, encoding, ", ".join(supported)))
+    return encoding
+
+
+def check_upload_options(options):
+    """Error message for options users may not set or values they may not use, None if all are fine"""
+    for k, v in options.items():
+        if k not in USER_OPTIONS:
+            return "Unknown upload option {}, use one of {}".format(k, ", ".join(sorted(USER_OPTIONS)))
+        if not any(type(v) == type(x) and v == x for x in USER_OPTIONS[k]):
+            return "Invalid value {} of the upload option {}, use one of {}".format(
+                json.dumps(v), k, ", ".join(json.dumps(x) for x in USER_OPTIONS[k]))
+    return None
+
+
+def count_local_mips(size, requested, chunk_size=CHUNK_SIZE):
+    """Number of 2x2x1 levels (at most requested) that still span more than one chunk"""
+    size = Vec(*size)
+    n = 0
+    while n < requested and size[0] > chunk_size[0] and size[1] > chunk_size[1]:
+        size = Vec(-(-size[0] // 2), -(-size[1] // 2), size[2])
+        n += 1
+    return n
+
+
+def downsample_pyramid(data, minpt, num_mips, segmentation):
+    """Yield successive 2x2x1 downsamples of data, whose first voxel is at minpt
+
+    Images are averaged and segmentations mode pooled. Levels are aligned to
+    the even grid of the next mip, so slabs can be downsampled independently.
+    """
+    import tinybrain
+    for _ in range(num_mips):
+        pad = [(minpt[0] % 2, 0), (minpt[1] % 2, 0), (0, 0)]
+        if pad[0][0] or pad[1][0]:
+            data = np.pad(data, pad, mode='edge')
+        minpt = Vec(minpt[0] // 2, minpt[1] // 2, minpt[2])
+        if segmentation:
+            data = tinybrain.downsample_segmentation(data, (2,2,1), num_mips=1)[0]
+        else:
+            data = tinybrain.downsample_with_averaging(data, (2,2,1), num_mips=1)[0]
+        yield data
+
+
+def write_levels(cvs, dst_bboxes, zslice, data, segmentation):
+    """Write a slab at the base mip and every level above it computed in memory"""
+    write_slab(cvs[0], dst_bboxes[0], zslice, data)
+    levels = downsample_pyramid(data, dst_bboxes[0].minpt, len(cvs)-1, segmentation)
+    for cv, dst_bbox, level in zip(cvs[1:], dst_bboxes[1:], levels):
+        write_slab(cv, dst_bbox, zslice, level)
+
+
+def choose_mesh_shape(size, chunk_size, min_tasks):
+    """Chunk aligned meshing task shape for a volume of the given size
+
+    Starts from the whole volume and halves the longer of x, y until there
+    are at least min_tasks tasks and each task is under MESH_TASK_VOXELS.
+    """
+    shape = [-(-s // c) * c for s, c in zip(size, chunk_size)]
+
+    def num_tasks():
+        return np.prod([-(-s // t) for s, t in zip(size, shape)])
+
+    while num_tasks() < min_tasks or np.prod(shape) > MESH_TASK_VOXELS:
+        candidates = [i for i in (0, 1) if shape[i] > chunk_size[i]]
+        if not candidates:
+            break
+        i = max(candidates, key=lambda i: shape[i])
+        shape[i] = -(-shape[i] // 2 // chunk_size[i]) * chunk_size[i]
+    return Vec(*shape)
+
+
+def write_changed_chunks(cv, dst_bbox, zslice, data, chunk_size, hashes, segmentation):
+    """Write the chunks of a slab whose hash is not in hashes, and update hashes
+
+    Returns the bboxes of the rewritten chunks and, for segmentations, the
+    ids of the segments whose voxels changed in them.
+    """
+    changed = []
+    segids = set()
+    for key, digest in chunk_hashes(data, chunk_size, zslice.start).items():
+        if hashes.get(key) == digest:
+            continue
+        local = chunk_slices(key, chunk_size, zslice.start)
+        chunk = data[local]
+        minpt = dst_bbox.minpt + Vec(local[0].start, local[1].start, zslice.start + local[2].start)
+        bbox = Bbox(minpt, minpt + Vec(*chunk.shape[:3]))
+        if segmentation:
+            old = cv[bbox.to_slices()][..., 0]
+            diff = old != chunk
+            segids.update(np.unique(old[diff]).tolist())
+            segids.update(np.unique(chunk[diff]).tolist())
+        cv[bbox.to_slices()] = chunk
+        hashes[key] = digest
+        changed.append(bbox)
+    segids.discard(0)
+    return changed, segids
+
+
+def downsample_bounds(cv, bbox, mip):
+    """Expand bbox (at mip) to whole downsampling tasks of the layer cv, opened at mip
+
+    Downsampling tasks start at the first voxel of their bounds and write
+    num_mips levels, so the bounds have to be aligned to chunk_size * 2^num_mips
+    from the voxel offset, otherwise the chunks written at the upper mips are
+    misaligned. num_mips is the number of levels the layer already has above
+    mip. Returns the mip 0 bounds and num_mips.
+    """
+    num_mips = len(cv.scales) - 1 - mip
+    grid = Vec(*cv.chunk_size) * Vec(1<<num_mips, 1<<num_mips, 1)
+    bounds = Bbox.clamp(bbox.expand_to_chunk_size(grid, offset=cv.voxel_offset), cv.bounds)
+    return cv.bbox_to_mip(bounds, mip, 0), num_mips
+
+
+def publish_revision(layer, author, number, changed_chunks):
+    cv = CloudVolume(layer)
+    cv.provenance.processing.append({
+        'owner': author,
+        'timestamp': str(datetime.today()),
+        'revision': number,
+        'changed_chunks': changed_chunks
+    })
+    cv.commit_provenance()
 
-    cv = CloudVolume(seg_layer, mip=mip, parallel=p, bounded=False, autocrop=True,
-                     cdn_cache=False, fill_missing=True)
-
-    print("original bbox")
-    print(mip0_bbox)
-    print(dst_bbox)
-    src_bbox = cv.bbox_to_mip(mip0_bbox, 0, mip)
-    dst_bbox = cv.bbox_to_mip(dst_bbox, 0, mip)
-    crop_bbox = dst_bbox - src_bbox.minpt
-    reply(handle, "loading the segments...".format(seg_layer))
-    print(src_bbox)
-    print(dst_bbox)
-    print(data.shape)
-    data = data[crop_bbox.to_slices()]
-    print(crop_bbox)
-    print(data.shape)
-    print(dst_bbox)
-    reply(handle, "uploading...".format(seg_layer))
-    cv[dst_bbox.to_slices()] = data
-
-    reply(handle, "meshing...")
-    with LocalTaskQueue(parallel=p) as tq:
-        tasks = tc.create_downsampling_tasks(seg_layer, mip=mip, fill_missing=True, preserve_chunk_size=True)
-        tq.insert_all(tasks)
-        print("downsampled")
-        tasks = tc.create_meshing_tasks(seg_layer, mip=mip, simplification=False, shape=(320, 320, 40),
-                              max_simplification_error=0)
+
+def delete_meshes(layer, segids):
+    """Remove the legacy mesh fragments and manifests of segids"""
+    mesh_dir = CloudVolume(layer).info['mesh']
+    with Storage(layer) as stor:
+        for segid in segids:
+            stor.delete_files(list(stor.list_files(prefix="{}/{}:".format(mesh_dir, segid))))
+
+
+def process_layer(name, layer, mip, parallel=PARALLEL, downsample=True, mesh_shape=(320, 320, 40), mesh_lod=0,
+                  bounds=None, object_ids=None, on_stage=None, num_mips=None):
+    """Downsample the layer, and mesh it if it is a segmentation
+
+    mesh_lod=0 writes the legacy per-segment meshes and manifests, otherwise
+    sharded multi-resolution meshes with mesh_lod levels of detail.
+    bounds (a mip 0 bbox list, aligned by downsample_bounds to num_mips levels)
+    and object_ids restrict an update to the changed part. on_stage(stage) is
+    called once the layer is 'downsampled' and again once it is 'meshed'.
+    """
+    if on_stage is None:
+        on_stage = lambda stage: None
+    with LocalTaskQueue(parallel=parallel) as tq:
+        if downsample:
+            tasks = tc.create_downsampling_tasks(layer, mip=mip, fill_missing=True, preserve_chunk_size=True,
+                                                 bounds=Bbox.from_list(bounds) if bounds is not None else None,
+                                                 num_mips=num_mips)
+            tq.insert_all(tasks)
+            print("downsampled {}".format(name))
+        on_stage('downsampled')
+        if is_image_layer(name):
+            return
+        if mesh_lod > 0:
+            tasks = tc.create_meshing_tasks(layer, mip=mip, shape=mesh_shape, sharded=True)
+            tq.insert_all(tasks)
+            print("meshed {}".format(name))
+            tasks = tc.create_sharded_multires_mesh_tasks(layer, num_lod=mesh_lod)
+            tq.insert_all(tasks)
+            on_stage('meshed')
+            return
+        if object_ids is not None:
+            if len(object_ids) == 0:
+                on_stage('meshed')
+                return
+            delete_meshes(layer, object_ids)
+        tasks = tc.create_meshing_tasks(layer, mip=mip, simplification=False, shape=mesh_shape,
+                              max_simplification_error=0, object_ids=object_ids)
         tq.insert_all(tasks)
-        print("meshed")
-        tasks = tc.create_mesh_manifest_tasks(seg_layer, magnitude=1)
+        print("meshed {}".format(name))
+        # enough manifest tasks (one per id prefix) to keep every process busy
+        tasks = tc.create_mesh_manifest_tasks(layer, magnitude=1 if parallel <= 10 else 2)
         tq.insert_all(tasks)
-
-    return seg_layer
+    on_stage('meshed')
 
 
 if __name__ == '__main__':